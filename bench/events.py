@@ -0,0 +1,73 @@
+""" Benchmark message bus event payloads
+
+Compares delivering a mute.add event to several subscribers the way the bus
+used to, expanding a kwargs dict into every handler call, with building one
+slotted MuteAdded event shared by all subscribers. Subscribers keep what they
+receive, as queued or logging subscribers do, so that retained payloads can be
+counted and measured.
+
+    python bench/events.py
+"""
+import os, sys, time, tracemalloc, types
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mantabot.core import messages
+from mantabot.apps.moderation import service   # registers MuteAdded
+
+PUBLISHES = 20000
+SUBSCRIBERS = 4
+
+channel = types.SimpleNamespace(id=1)
+member = types.SimpleNamespace(id=2)
+user = types.SimpleNamespace(id=3)
+
+
+class Subscriber(object):
+    def __init__(self):
+        self.received = []
+
+    async def old_handler(self, **data):
+        self.received.append(data)
+
+    async def new_handler(self, event):
+        self.received.append(event)
+
+
+def drive(coro):
+    try:
+        coro.send(None)
+    except StopIteration:
+        pass
+
+def before(subscribers):
+    data = {'channel': channel, 'member': member, 'duration': 600.0, 'user': user, 'reason': None}
+    for subscriber in subscribers:
+        drive(subscriber.old_handler(**data))
+
+def after(subscribers):
+    event = messages.make_event('mute.add', channel=channel, member=member, duration=600.0, user=user)
+    for subscriber in subscribers:
+        drive(subscriber.new_handler(event))
+
+def run(name, publish):
+    subscribers = [Subscriber() for _ in range(SUBSCRIBERS)]
+    tracemalloc.start()
+    start_size = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    for _ in range(PUBLISHES):
+        publish(subscribers)
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0] - start_size
+    tracemalloc.stop()
+
+    payloads = len(set(id(item) for subscriber in subscribers for item in subscriber.received))
+    print('%-8s %5.1f payload objects/publish  %6.0f bytes/publish  %5.2f µs/publish' % (
+          name, payloads / PUBLISHES, size / PUBLISHES, 1e6 * elapsed / PUBLISHES))
+
+def main():
+    print('%d subscribers' % SUBSCRIBERS)
+    run('before', before)
+    run('after', after)
+
+if __name__ == '__main__':
+    main()
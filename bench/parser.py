@@ -0,0 +1,79 @@
+""" Benchmark command parsing
+
+Compares the previous parsing, which ran shlex.split on the first line of
+every message starting with a prefix before looking the command name up, with
+the prefix and name matcher followed by the regex tokenizer. Command and
+non-command traffic are measured separately.
+
+    python bench/parser.py
+"""
+import os, shlex, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mantabot.command import dispatcher, parser
+
+ROUNDS = 20000
+PREFIXES = ('!', '#')
+ROUTES = ('ban', 'clear', 'cmdadd', 'cmdlist', 'cmdprefix', 'cmdremove',
+          'history', 'mute', 'readonly', 'unmute')
+
+COMMANDS = [
+    '!mute 10 <@123456789012345678> <@234567890123456789>',
+    '!ban <@123456789012345678> "spamming links in every channel"',
+    '#cmdadd moderators moderation "#general" #help',
+    '!clear 50 force',
+    '!history <@123456789012345678> 7',
+    '!readonly on\nsecond line is ignored',
+]
+NON_COMMANDS = [
+    '#general is really busy today, could someone have a look?',
+    '!!! that was amazing',
+    '#1 best server ever, no doubt about it',
+    'hello everyone, how is it going?',
+    "!play never gonna give you up",
+]
+
+
+def before(content):
+    if not content or content[0] not in PREFIXES:
+        return None
+    try:
+        args = shlex.split(content[1:].split('\n', 1)[0])
+        name = args.pop(0).lower()
+    except (ValueError, IndexError):
+        return None
+    if name not in ROUTES:
+        return None
+    return name, args
+
+matcher = dispatcher.CommandMatcher(PREFIXES, ROUTES)
+
+def after(content):
+    found = matcher.match(content)
+    if found is None:
+        return None
+    prefix_length, name = found
+    endpos = content.find('\n')
+    if endpos < 0:
+        endpos = len(content)
+    try:
+        return name, parser.split(content, prefix_length + len(name), endpos)
+    except ValueError:
+        return None
+
+def run(traffic, name, parse, messages):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for content in messages:
+            parse(content)
+    elapsed = time.perf_counter() - start
+    print('%-12s %-8s %6.2f µs/message' % (traffic, name, 1e6 * elapsed / (ROUNDS * len(messages))))
+
+def main():
+    for traffic, messages in (('commands', COMMANDS), ('non-commands', NON_COMMANDS)):
+        assert [before(content) for content in messages] == [after(content) for content in messages]
+        run(traffic, 'before', before, messages)
+        run(traffic, 'after', after, messages)
+
+if __name__ == '__main__':
+    main()
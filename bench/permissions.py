@@ -0,0 +1,73 @@
+""" Benchmark command permission lookups
+
+Compares the linear scan DBDispatcher used to run over every entry of a
+guild, testing each against all member roles, with the compiled per-guild
+index. Guilds have a few hundred permission rows spread over command groups,
+roles and channels; members have a handful of roles.
+
+    python bench/permissions.py
+"""
+import os, random, sys, time, types
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mantabot.command import dbdispatcher
+
+LOOKUPS = 100000
+GROUPS = 8
+ROLES = 60
+CHANNELS = 40
+
+
+def make_entries(count, rng):
+    entries = []
+    for _ in range(count):
+        channels = None
+        if rng.random() < 0.7:
+            channels = tuple(rng.sample(range(CHANNELS), rng.randint(1, 4)))
+        entries.append(dbdispatcher.Entry(
+            group_name='group%d' % rng.randrange(GROUPS),
+            role=rng.randrange(ROLES),
+            channels=channels,
+            settings={},
+        ))
+    return entries
+
+def make_lookups(rng):
+    lookups = []
+    for _ in range(LOOKUPS):
+        roles = [types.SimpleNamespace(id=role_id) for role_id in rng.sample(range(ROLES), 5)]
+        lookups.append(('group%d' % rng.randrange(GROUPS), rng.randrange(CHANNELS), roles))
+    return lookups
+
+def before(entries, group_name, channel_id, roles):
+    return next((
+        entry for entry in entries
+        if entry.group_name == group_name and
+           (not entry.channels or channel_id in entry.channels) and
+           any(role.id == entry.role for role in roles)
+        ), None
+    )
+
+def after(permissions, group_name, channel_id, roles):
+    return permissions.get_entry(group_name, channel_id, {role.id for role in roles})
+
+def run(name, count, lookup, lookups):
+    start = time.perf_counter()
+    results = [lookup(*args) for args in lookups]
+    elapsed = time.perf_counter() - start
+    print('%4d rows  %-8s %10.0f lookups/s  %6.2f µs/lookup' % (
+          count, name, len(lookups) / elapsed, 1e6 * elapsed / len(lookups)))
+    return results
+
+def main():
+    rng = random.Random(42)
+    lookups = make_lookups(rng)
+    for count in (100, 300, 1000):
+        entries = make_entries(count, rng)
+        permissions = dbdispatcher.GuildPermissions(entries)
+        expected = run('before', count, lambda *args: before(entries, *args), lookups)
+        results = run('after', count, lambda *args: after(permissions, *args), lookups)
+        assert results == expected, 'lookups disagree'
+
+if __name__ == '__main__':
+    main()
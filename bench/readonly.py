@@ -0,0 +1,108 @@
+""" Benchmark the ReadOnly message handler
+
+Compares message throughput of the handler as it was before the in-memory
+guild state, when every message awaited the settings cache and the mute
+state, with the current handler. Traffic is spread over 50 channels, one of
+them readonly and one with a mute.
+
+    python bench/readonly.py
+"""
+import asyncio, os, sys, time, types
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import discord
+from mantabot import db
+from mantabot.apps.moderation import service
+from mantabot.apps.moderation.handlers import readonly
+
+MESSAGES = 200000
+CHANNELS = 50
+AUTHORS = 20
+
+
+class Guild(object):
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class Channel(discord.abc.GuildChannel):
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+
+
+class Message(object):
+    def __init__(self, channel, author):
+        self.channel = channel
+        self.author = author
+
+
+class Deletion(object):
+    """ Stands for the deletion queue, only counting messages """
+    def __init__(self):
+        self.count = 0
+
+    def delete(self, message):
+        self.count += 1
+
+# ============================================================================
+# Handler before the in-memory guild state
+
+async def get_readonly(channel):
+    settings = await db.settings.get(service.SETTINGS_KEY, channel.guild, loader=service.settings_loader)
+    return channel.id in settings.setdefault('readonly', [])
+
+async def get_channel_member_muted(channel, member):
+    state = await service.get_state(channel.guild)
+    expiration = state.get_mute(channel.id, member.id)
+    return expiration is not None and expiration > service.now()
+
+async def before(message, deletion):
+    channel = message.channel
+    if not isinstance(channel, discord.abc.GuildChannel):
+        return
+    if message.author.bot:
+        return
+    if await get_readonly(channel):
+        deletion.delete(message)
+    if await get_channel_member_muted(channel, message.author):
+        deletion.delete(message)
+
+# ============================================================================
+
+def setup():
+    guild = Guild(1)
+    channels = [Channel(100 + idx, guild) for idx in range(CHANNELS)]
+    authors = [types.SimpleNamespace(id=1000 + idx, bot=False) for idx in range(AUTHORS)]
+
+    state = service.GuildState(guild.id)
+    state.readonly = frozenset((channels[0].id,))
+    state.add_mute(channels[1].id, authors[0].id, int(service.now() + 3600))
+    service._states[guild.id] = state
+    db.settings._store((service.SETTINGS_KEY, guild.id),
+                       db.DBSettingsProxy(service.SETTINGS_KEY, guild.id, {'readonly': [channels[0].id]}))
+
+    return [Message(channels[idx % CHANNELS], authors[idx % AUTHORS]) for idx in range(MESSAGES)]
+
+async def run(name, handle, messages):
+    start = time.perf_counter()
+    for message in messages:
+        await handle(message)
+    elapsed = time.perf_counter() - start
+    print('%-8s %10.0f messages/s  %6.2f µs/message' % (name, len(messages) / elapsed, 1e6 * elapsed / len(messages)))
+
+def main():
+    loop = asyncio.get_event_loop()
+    messages = setup()
+
+    deletion = Deletion()
+    loop.run_until_complete(run('before', lambda message: before(message, deletion), messages))
+
+    handler = readonly.ReadOnly(types.SimpleNamespace(loop=loop))
+    handler.deletion = Deletion()
+    loop.run_until_complete(run('after', handler.on_message, messages))
+
+    assert deletion.count == handler.deletion.count, 'handlers disagree'
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from mantabot.core import messages, plugins
+from mantabot.core import messages, plugins, stats, tasks
 VERSION = (1, 0)
 
-__all__ = ('messages', 'plugins')
+__all__ = ('messages', 'plugins', 'stats', 'tasks')
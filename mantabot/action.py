@@ -6,6 +6,31 @@ default_logger = logging.getLogger(__name__)
 
 # ============================================================================
 
+@messages.Event.register
+class ActionCopy(messages.Event):
+    name = 'action.copy'
+    __slots__ = ('message', 'channel')
+
+
+@messages.Event.register
+class ActionDelete(messages.Event):
+    name = 'action.delete'
+    __slots__ = ('message',)
+
+
+@messages.Event.register
+class ActionPin(messages.Event):
+    name = 'action.pin'
+    __slots__ = ('message',)
+
+
+@messages.Event.register
+class ActionGrantRole(messages.Event):
+    name = 'action.grant_role'
+    __slots__ = ('member', 'role', 'reason')
+
+# ============================================================================
+
 class Action(object):
     """ Encapsulate an action taken as a consequence to a message """
     registry = {}
@@ -0,0 +1,146 @@
+""" Moderation audit store
+
+Moderation events published on guild buses are buffered for a short window,
+then written to the moderation_event table with multi-row inserts.
+"""
+import asyncio, datetime, logging
+from mantabot import db, messages, stats, tasks
+from mantabot.apps.log import models
+
+logger = logging.getLogger(__name__)
+
+DETAILS = ('reason', 'duration', 'enable', 'invoked_name', 'args')
+
+
+def make_row(guild_id, event):
+    """ Build a moderation_event row from a bus event """
+    user = getattr(event, 'user', None)
+    member = getattr(event, 'member', None)
+    channel = getattr(event, 'channel', None)
+    if channel is None:
+        message = getattr(event, 'message', None)
+        channel = message and message.channel
+    details = {}
+    for key in DETAILS:
+        value = getattr(event, key, None)
+        if value is not None:
+            details[key] = value
+    return {
+        'guild_id': guild_id,
+        'created_at': datetime.datetime.utcnow(),
+        'event': event.name,
+        'user_id': user and user.id,
+        'member_id': member and member.id,
+        'channel_id': channel and channel.id,
+        'details': details,
+    }
+
+
+class AuditWriter(object):
+    """ Buffer of rows to insert, shared by all guilds """
+
+    delay = 2.0             # seconds rows are collected for before writing them
+    batch_size = 500        # maximum number of rows per insert
+
+    def __init__(self):
+        self.rows = []
+        self.task = None
+        self.written = 0
+        self.inserts = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            tasks.supervisor.spawn(self.flush(), 'audit')
+        elif self.task is None:
+            self.task = tasks.supervisor.spawn(self._delayed_flush(), 'audit')
+
+    async def _delayed_flush(self):
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.task = None
+        await self.flush()
+
+    async def flush(self):
+        """ Write all buffered rows now """
+        rows, self.rows = self.rows, []
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            try:
+                async with await db.connection() as conn:
+                    await conn.execute(models.ModerationEvent.insert().values(batch))
+            except Exception:
+                logger.exception('could not record %d moderation events', len(batch))
+            else:
+                self.written += len(batch)
+                self.inserts += 1
+
+    def stats(self):
+        return {'pending': len(self.rows), 'written': self.written, 'inserts': self.inserts}
+
+writer = AuditWriter()
+stats.reporter.register('audit', writer.stats)
+
+
+class AuditRecorder(object):
+    """ Record moderation events of a guild """
+
+    events = ('ban', 'unban', 'mute.add', 'mute.remove', 'readonly.set', 'command.run')
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+
+    def subscribe(self, bus, queue=100):
+        # Named subscriptions, so other events are not even built for us. They share
+        # a queue, so pending events can be drained on shutdown.
+        queue = messages.SubscriberQueue(bus, queue)
+        for event in self.events:
+            bus.subscribe_method(self, 'record', event, queue=queue)
+        return self
+
+    async def record(self, event):
+        writer.add(make_row(self.guild_id, event))
+
+# ============================================================================
+# History
+
+def history_query(guild_id, member_id=None, since=None, until=None, before=None, limit=20):
+    """ Build a query for a page of moderation events, newest first
+
+        Paging is keyset-based: pass the event_id of the last event of a page as
+        before to get the next page.
+    """
+    table = models.ModerationEvent
+    query = table.select().where(table.c.guild_id == guild_id)
+    if member_id is not None:
+        query = query.where(table.c.member_id == member_id)
+    if since is not None:
+        query = query.where(table.c.created_at >= since)
+    if until is not None:
+        query = query.where(table.c.created_at < until)
+    if before is not None:
+        query = query.where(table.c.event_id < before)
+    return query.order_by(table.c.event_id.desc()).limit(limit)
+
+async def history(guild_id, **kwargs):
+    """ Return a page of moderation events, see history_query """
+    async with await db.connection() as conn:
+        result = await conn.execute(history_query(guild_id, **kwargs))
+        return await result.fetchall()
+
+def format_row(row, names=None):
+    """ Format a moderation event as a single line, names maps ids to display names """
+    names = names or {}
+    def name(snowflake):
+        return names.get(snowflake) or str(snowflake)
+
+    parts = ['#%d' % row.event_id, row.created_at.strftime('%Y-%m-%d %H:%M'), row.event]
+    if row.user_id is not None:
+        parts.append('by ' + name(row.user_id))
+    if row.member_id is not None:
+        parts.append('on ' + name(row.member_id))
+    if row.channel_id is not None:
+        parts.append('in ' + name(row.channel_id))
+    parts.extend('%s=%s' % (key, value) for key, value in sorted(row.details.items()))
+    return ' '.join(parts)
@@ -0,0 +1,67 @@
+import datetime
+from mantabot import command
+from mantabot.apps.log import audit
+
+
+class History(command.Command):
+    """ Bot command that shows moderation history """
+    name = 'history'
+    limit = 20
+
+    errors = {
+        'usage': '{name} [<\@name>] [days] [before]\n'
+                 '→ *days*: only show events from that many last days.\n'
+                 '→ *before*: only show events older than that event number.',
+    }
+
+    messages = {
+        'empty': 'no moderation event recorded.',
+        'more': 'more with `{name} {member}{days} {before}`',
+    }
+
+    async def execute(self, message, args):
+        guild = message.channel.guild
+        member = message.mentions[0] if len(message.mentions) == 1 else None
+        numbers = [arg for arg in args if not arg.startswith('<')]
+        try:
+            days, before = (list(map(int, numbers)) + [None, None])[:2]
+        except ValueError:
+            return await self.error('usage', name=self.name)
+        if len(numbers) > 2 or len(message.mentions) > 1:
+            return await self.error('usage', name=self.name)
+
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=days) if days else None
+        rows = await audit.history(guild.id, member_id=member and member.id, since=since,
+                                   before=before, limit=self.limit)
+        if not rows:
+            return await self.send(self.messages['empty'])
+
+        names = {}
+        for row in rows:
+            for member_id in (row.user_id, row.member_id):
+                found = member_id and guild.get_member(member_id)
+                if found:
+                    names[member_id] = found.display_name
+            channel = row.channel_id and guild.get_channel(row.channel_id)
+            if channel:
+                names[row.channel_id] = '#' + channel.name
+        lines = [audit.format_row(row, names) for row in rows]
+        text = '```\n%s\n```' % '\n'.join(lines)
+        while len(text) > 1900:
+            lines.pop()
+            text = '```\n%s\n```' % '\n'.join(lines)
+        await self.send(text)
+
+        if len(rows) == self.limit or len(lines) < len(rows):
+            await self.send(self.messages['more'].format(
+                name=self.name,
+                member=member.mention + ' ' if member else '',
+                days=days or 0,
+                before=rows[len(lines) - 1].event_id,
+            ))
+
+
+log_group = command.CommandGroup('log')
+log_group.register(History)
+
+__all__ = ('History',)
@@ -1,9 +1,108 @@
-import discord, re
-from mantabot import db, messages
+import asyncio, datetime, discord, logging, re, time
+from mantabot import conf, db, messages, tasks
+from mantabot.apps.log import audit
+
+logger = logging.getLogger(__name__)
+
+db.settings.register('log')
 
 # ============================================================================
 
+class AuditCorrelator(object):
+    """ Find audit log entries matching member events, with one fetch per guild and window
+
+        Events are collected per guild and action for a short window, then the
+        audit log is fetched once, with a limit large enough for all of them.
+        Unclaimed entries are kept for a while, for events arriving late. An entry
+        is handed out at most once, and entries older than ttl are never matched,
+        so a repeated action on the same member does not reuse a previous one.
+    """
+    delay = 1.0         # seconds events are collected for before fetching the audit log
+    min_limit = 10      # audit log entries fetched for a single event
+    max_limit = 100     # maximum audit log entries per fetch
+    ttl = 60            # seconds entries can be matched for
+
+    def __init__(self, client):
+        self.client = client
+        self.pending = {}   # (guild_id, action) => {target_id: future}
+        self.entries = {}   # (guild_id, action) => {target_id: entry}
+        self.claimed = {}   # entry id => time it was handed out
+        self.fetches = 0
+
+    def _cutoff(self):
+        return datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+
+    def _claim(self, entry):
+        if entry is not None:
+            self.claimed[entry.id] = time.monotonic()
+        return entry
+
+    async def find(self, guild, action, target):
+        """ Return the audit log entry for action on target, or None if there is none """
+        key = (guild.id, action)
+        entry = self.entries.get(key, {}).pop(target.id, None)
+        if entry is not None and entry.created_at > self._cutoff():
+            return self._claim(entry)
+
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = self.pending[key] = {}
+            tasks.supervisor.spawn(self._fetch(guild, action), 'log', guild.id)
+        future = pending.get(target.id)
+        if future is None:
+            future = pending[target.id] = self.client.loop.create_future()
+        return await asyncio.shield(future, loop=self.client.loop)
+
+    async def _fetch(self, guild, action):
+        key = (guild.id, action)
+        try:
+            await asyncio.sleep(self.delay, loop=self.client.loop)
+        except asyncio.CancelledError:
+            for future in self.pending.pop(key).values():
+                future.cancel()
+            raise
+        pending = self.pending.pop(key)
+
+        fetched = {}
+        try:
+            limit = min(max(2 * len(pending), self.min_limit), self.max_limit)
+            self.fetches += 1
+            async for entry in guild.audit_logs(limit=limit, action=action):
+                fetched.setdefault(entry.target.id, entry)   # newest first
+        except Exception as exc:
+            logger.warning('could not fetch audit log of guild %s: %s', guild.id, exc)
+        finally:
+            # Merge into current entries, find() may have claimed some while fetching
+            cutoff = self._cutoff()
+            entries = self.entries.setdefault(key, {})
+            for target_id, entry in fetched.items():
+                if entry.id not in self.claimed and entry.created_at > cutoff:
+                    entries[target_id] = entry
+            for target_id, future in pending.items():
+                entry = self._claim(entries.pop(target_id, None))
+                if not future.done():
+                    future.set_result(entry)
+            self._prune(key, cutoff)
+
+    def _prune(self, key, cutoff):
+        entries = self.entries.get(key, {})
+        for target_id in [target_id for target_id, entry in entries.items() if entry.created_at <= cutoff]:
+            del entries[target_id]
+        if not entries:
+            self.entries.pop(key, None)
+        # entries older than ttl are never matched, so neither are their claims needed
+        limit = time.monotonic() - 2 * self.ttl
+        for entry_id in [entry_id for entry_id, claimed_at in self.claimed.items() if claimed_at < limit]:
+            del self.claimed[entry_id]
+
+    def forget(self, guild_id):
+        """ Drop cached entries of a guild """
+        for key in [key for key in self.entries if key[0] == guild_id]:
+            del self.entries[key]
+
+
 class FeedsHandler(object):
+    concurrent = True   # does not depend on other handlers, can run alongside them
     publish_types = {}
     @classmethod
     def register(cls, name):
@@ -15,6 +114,28 @@ class FeedsHandler(object):
     def __init__(self, client):
         self.client = client
         self.guilds = {}
+        options = conf.settings.get('log') or {}
+        self.queue_size = options.get('queue_size', 100)
+        self.overflow = options.get('overflow', 'drop_oldest')
+        self.audit = options.get('audit', True)
+        self.correlator = AuditCorrelator(client)
+        messages.bus().subscribe(self)
+
+    @messages.event_handler('core.close')
+    async def flush_feeds(self, event):
+        """ Send buffered lines and audit events before the client disconnects """
+        # Deliver events still queued for our subscribers, before supervised tasks get cancelled
+        await asyncio.gather(*(
+            messages.bus(guild_id).drain(publisher)
+            for guild_id, objects in self.guilds.items()
+            for publisher in objects
+        ), loop=self.client.loop, return_exceptions=True)
+        await asyncio.gather(audit.writer.flush(), *(
+            publisher.flush()
+            for objects in self.guilds.values()
+            for publisher in objects
+            if hasattr(publisher, 'flush')
+        ), loop=self.client.loop, return_exceptions=True)
 
     async def on_ready(self):
         for guild in self.client.guilds:
@@ -31,35 +152,50 @@ class FeedsHandler(object):
         objects = []
 
         for kind, channel_id in settings.get('feeds', {}).items():
-            channel = guild.get_channel(channel_id)
-            publisher = self.publish_types[kind](guild, channel)
-            messages.bus(guild).subscribe(publisher)
+            publisher = self.publish_types[kind](self.client, guild.id, channel_id)
+            messages.bus(guild.id).subscribe(publisher, queue=self.queue_size, overflow=self.overflow)
             objects.append(publisher)
 
+        # The guild's own setting, if any, overrides the configured default
+        if settings.get('audit', self.audit):
+            recorder = audit.AuditRecorder(guild.id)
+            objects.append(recorder.subscribe(messages.bus(guild.id), queue=self.queue_size or 100))
+
+        # Buses hold subscribers weakly, this keeps them alive until the guild is removed
         self.guilds[guild.id] = objects
 
+    async def on_guild_remove(self, guild):
+        self.guilds.pop(guild.id, None)
+        self.correlator.forget(guild.id)
+
     async def on_member_ban(self, guild, user):
-        async for entry in guild.audit_logs(limit=5, action=discord.AuditLogAction.ban):
-            if entry.target.id == user.id:
-                break
-        else:
-            return
-        if entry.user.id != guild.me.id:
-            messages.bus(guild).publish('ban', user=entry.user, member=user, reason=entry.reason)
+        # Looking the entry up takes a while, do not hold the guild's other events
+        tasks.supervisor.spawn(self.report_ban(guild, user), 'log', guild.id)
 
     async def on_member_unban(self, guild, user):
-        async for entry in guild.audit_logs(limit=5, action=discord.AuditLogAction.unban):
-            if entry.target.id == user.id:
-                break
-        else:
-            return
-        if entry.user.id != guild.me.id:
+        tasks.supervisor.spawn(self.report_unban(guild, user), 'log', guild.id)
+
+    async def report_ban(self, guild, user):
+        entry = await self.correlator.find(guild, discord.AuditLogAction.ban, user)
+        if entry is not None and entry.user.id != guild.me.id:
+            messages.bus(guild).publish('ban', user=entry.user, member=user, reason=entry.reason)
+
+    async def report_unban(self, guild, user):
+        entry = await self.correlator.find(guild, discord.AuditLogAction.unban, user)
+        if entry is not None and entry.user.id != guild.me.id:
             messages.bus(guild).publish('unban', user=entry.user, member=user)
 
 # ============================================================================
 
 @FeedsHandler.register('logs')
 class Logger(object):
+    """ Post log lines to a channel
+
+        Lines are buffered for a short window, then posted together in as few
+        messages as the message length limit allows.
+    """
+    delay = 1.0             # seconds lines are collected for before posting them
+    max_length = 2000       # maximum length of a discord message
     templates = {
         'action.grant_role': 'I granted role **{role.name}** to '
                              '{member.mention} [{member.name}#{member.discriminator}] :'
@@ -73,19 +209,62 @@ class Logger(object):
                  '[{member.name}#{member.discriminator}]',
     }
 
-    def __init__(self, guild, channel):
-        self.guild = guild
-        self.channel = channel
+    def __init__(self, client, guild_id, channel_id):
+        self.client = client
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.lines = []
+        self.pending = None     # delayed flush task
 
     @messages.event_handler('*')
-    async def log(self, event, **data):
-        await getattr(self, 'log_' + event.replace('.', '__'), self.default_logger)(event, **data)
+    async def log(self, event):
+        await getattr(self, 'log_' + event.name.replace('.', '__'), self.default_logger)(event)
+
+    async def default_logger(self, event, fields=None):
+        template = self.templates.get(event.name)
+        if not template:
+            return
+        self.write(template.format_map(event if fields is None else fields))
+
+    async def log_readonly__set(self, event):
+        fields = dict(event.items(), verb='enabled' if event.enable else 'disabled')
+        await self.default_logger(event, fields)
+
+    def write(self, line):
+        """ Buffer a line for posting """
+        if len(line) > self.max_length:
+            line = line[:self.max_length - 1] + '…'
+        self.lines.append(line)
+        if self.pending is None:
+            self.pending = tasks.supervisor.spawn(self._delayed_flush(), 'log', self.guild_id)
+
+    async def _delayed_flush(self):
+        try:
+            await asyncio.sleep(self.delay, loop=self.client.loop)
+        finally:
+            self.pending = None
+        await self.flush()
+
+    async def flush(self):
+        """ Post all buffered lines now """
+        lines, self.lines = self.lines, []
+        if not lines:
+            return
+        channel = self.client.get_channel(self.channel_id)
+        if channel is None:
+            return
 
-    async def default_logger(self, event, **data):
-        template = self.templates.get(event)
-        if template:
-            await self.channel.send(template.format(**data))
+        chunk, length = [], 0
+        for line in lines:
+            if chunk and length + 1 + len(line) > self.max_length:
+                await self._send(channel, chunk)
+                chunk, length = [], 0
+            length += len(line) + (1 if chunk else 0)
+            chunk.append(line)
+        await self._send(channel, chunk)
 
-    async def log_readonly__set(self, event, **data):
-        data['verb'] = 'enabled' if data['enable'] else 'disabled'
-        await self.default_logger(event, **data)
+    async def _send(self, channel, lines):
+        try:
+            await channel.send('\n'.join(lines))
+        except discord.HTTPException as exc:
+            logger.warning('could not post %d log lines to channel %s: %s', len(lines), channel.id, exc)
@@ -0,0 +1,33 @@
+import datetime
+from mantabot import db
+from mantabot.core import management
+from mantabot.apps.log import audit
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+@management.Command.register
+class History(management.Command):
+    help = 'show moderation history of a guild'
+
+    def add_arguments(self, parser):
+        parser.add_argument('guild', type=int, help='guild id')
+        parser.add_argument('--member', type=int, help='only show events on that member id')
+        parser.add_argument('--since', type=parse_date, help='start date, as YYYY-MM-DD')
+        parser.add_argument('--until', type=parse_date, help='end date, as YYYY-MM-DD, excluded')
+        parser.add_argument('--before', type=int, help='only show events older than that event id')
+        parser.add_argument('--limit', type=int, default=50, help='number of events to show')
+
+    def handle(self, guild, member=None, since=None, until=None, before=None, limit=50, **kwargs):
+        query = audit.history_query(guild, member_id=member, since=since, until=until,
+                                    before=before, limit=limit)
+        with db.management_connection() as connection:
+            rows = connection.execute(query).fetchall()
+
+        for row in rows:
+            self.write(audit.format_row(row))
+        if len(rows) == limit:
+            self.write('more with --before %d' % rows[-1].event_id)
+        return 0
@@ -0,0 +1,15 @@
+from mantabot import db
+
+ModerationEvent = db.Table('moderation_event', db.metadata,
+    db.Column('event_id', db.BigInteger, primary_key=True),
+    db.Column('guild_id', db.BigInteger, nullable=False),
+    db.Column('created_at', db.DateTime, nullable=False),     # utc
+    db.Column('event', db.String(32), nullable=False),
+    db.Column('user_id', db.BigInteger, nullable=True),       # member who acted
+    db.Column('member_id', db.BigInteger, nullable=True),     # member acted upon
+    db.Column('channel_id', db.BigInteger, nullable=True),
+    db.Column('details', db.postgresql.JSONB, nullable=False),
+    db.Index('ix_moderation_event_guild', 'guild_id', 'event_id'),
+    db.Index('ix_moderation_event_member', 'guild_id', 'member_id', 'event_id'),
+    db.Index('ix_moderation_event_time', 'guild_id', 'created_at'),
+)
@@ -0,0 +1,93 @@
+""" Batched message deletion
+
+Messages to delete are collected per channel for a short window, then removed
+with bulk deletion calls of up to 100 messages each.
+"""
+import asyncio, datetime, discord, logging
+from mantabot import tasks
+
+logger = logging.getLogger(__name__)
+
+
+class DeletionQueue(object):
+    """ Per-channel queues of messages to delete """
+
+    delay = 0.3             # seconds messages are collected for before deleting them
+    bulk_limit = 100        # maximum number of messages per bulk deletion
+    max_age = 1209600       # messages older than 14 days cannot be bulk-deleted
+
+    def __init__(self, loop=None, on_forbidden=None):
+        self.loop = loop
+        self.on_forbidden = on_forbidden    # coroutine function, called with channel
+        self.pending = {}                   # channel_id => (channel, {message_id: message})
+        self.deleted = 0                    # messages deleted
+        self.calls = 0                      # api calls used to delete them
+        self.saved = 0                      # api calls avoided by bulk deletion
+
+    def delete(self, message):
+        """ Schedule message deletion """
+        channel = message.channel
+        try:
+            self.pending[channel.id][1][message.id] = message
+        except KeyError:
+            self.pending[channel.id] = (channel, {message.id: message})
+            tasks.supervisor.spawn(self._delayed_flush(channel.id), 'deletion', channel.guild)
+
+    async def _delayed_flush(self, channel_id):
+        await asyncio.sleep(self.delay, loop=self.loop)
+        channel, batch = self.pending.pop(channel_id)
+        try:
+            await self.flush(channel, list(batch.values()))
+        except discord.Forbidden:
+            if self.on_forbidden is not None:
+                await self.on_forbidden(channel)
+        except discord.HTTPException as exc:
+            logger.warning('could not delete messages in channel %s: %s', channel.name, exc)
+
+    async def flush(self, channel, messages):
+        """ Delete messages from channel with as few calls as possible """
+        limit = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.max_age - 60)
+        recent = [message for message in messages if message.created_at > limit]
+        await self._delete_each(message for message in messages if message.created_at <= limit)
+
+        for idx in range(0, len(recent), self.bulk_limit):
+            chunk = recent[idx:idx + self.bulk_limit]
+            if len(chunk) == 1:
+                await self._delete_one(chunk[0])
+                continue
+            try:
+                await channel.delete_messages(chunk)
+            except discord.Forbidden:
+                raise
+            except discord.HTTPException:
+                await self._delete_each(chunk)
+            else:
+                self.calls += 1
+                self.deleted += len(chunk)
+                self.saved += len(chunk) - 1
+
+    async def _delete_each(self, messages):
+        """ Delete messages one by one, a failure does not prevent deleting the others """
+        for message in messages:
+            try:
+                await self._delete_one(message)
+            except discord.Forbidden:
+                raise
+            except discord.HTTPException as exc:
+                logger.warning('could not delete message %s: %s', message.id, exc)
+
+    async def _delete_one(self, message):
+        self.calls += 1
+        try:
+            await message.delete()
+        except discord.NotFound:
+            return      # this is okay, message is already deleted
+        self.deleted += 1
+
+    def stats(self):
+        return {
+            'depth': sum(len(batch) for channel, batch in self.pending.values()),
+            'deleted': self.deleted,
+            'calls': self.calls,
+            'saved': self.saved,
+        }
@@ -1,5 +1,6 @@
 import discord
-from mantabot.apps.moderation import service
+from mantabot import stats
+from mantabot.apps.moderation import deletion, service
 
 
 class ReadOnly(object):
@@ -8,6 +9,20 @@ class ReadOnly(object):
 
     def __init__(self, client):
         self.client = client
+        self.deletion = deletion.DeletionQueue(loop=client.loop, on_forbidden=self.on_delete_forbidden)
+        stats.reporter.register('deletion', self.deletion.stats)
+
+    async def warm_up(self, guilds):
+        await service.warm_up(guilds)
+
+    async def on_ready(self):
+        service.expiry.start(self.client)
+
+    async def on_guild_remove(self, guild):
+        service.forget_guild(guild.id)
+
+    async def on_member_join(self, member):
+        await service.reschedule_member(member)
 
     async def on_message(self, message):
         channel = message.channel
@@ -16,18 +31,18 @@ class ReadOnly(object):
         if message.author.bot:
             return
 
-        # Handle readonly
+        state = service.peek_state(channel.guild)
+        if state is None:
+            state = await service.get_state(channel.guild)
+
+        # Fast path: most channels have neither readonly nor mutes
+        if channel.id not in state.readonly and channel.id not in state.mutes:
+            return
+
+        # Handle readonly and mutes - deletions are batched to survive floods
+        if channel.id in state.readonly or state.is_muted(channel.id, message.author.id):
+            self.deletion.delete(message)
+
+    async def on_delete_forbidden(self, channel):
         if await service.get_readonly(channel):
-            try:
-                await message.delete()
-            except discord.NotFound:
-                pass # this is okay, message is already deleted
-            except discord.Forbidden:
-                await service.set_readonly(channel, False, user=channel.guild.me, reason='forbidden')
-
-        # Handle mutes
-        if await service.get_channel_member_muted(channel, message.author):
-            try:
-                await message.delete()
-            except (discord.NotFound, discord.Forbidden):
-                pass
+            await service.set_readonly(channel, False, user=channel.guild.me, reason='forbidden')
@@ -0,0 +1,10 @@
+from mantabot import db
+
+Mute = db.Table('moderation_mute', db.metadata,
+    db.Column('guild_id', db.BigInteger, primary_key=True),
+    db.Column('channel_id', db.BigInteger, primary_key=True),
+    db.Column('member_id', db.BigInteger, primary_key=True),
+    db.Column('expires_at', db.BigInteger, nullable=False, index=True),
+    db.Column('overwritten', db.Boolean, nullable=False, default=False),
+    db.Column('previous', db.Boolean, nullable=True),   # send_messages before overwrite
+)
@@ -1,105 +1,487 @@
-import datetime
-from mantabot import db, messages
+import asyncio, datetime, discord, heapq, logging
+from mantabot import conf, db, messages, tasks
+from mantabot.apps.moderation import models
+from mantabot.util import generation, singleflight
+
+logger = logging.getLogger(__name__)
 
 SETTINGS_KEY = 'moderation'
 
 class BotPermissionDenied(RuntimeError):
     pass
 
+# ============================================================================
+# Events published on guild buses
+
+@messages.Event.register
+class MuteAdded(messages.Event):
+    name = 'mute.add'
+    __slots__ = ('channel', 'member', 'duration', 'user', 'reason')
+
+
+@messages.Event.register
+class MuteRemoved(messages.Event):
+    name = 'mute.remove'
+    __slots__ = ('channel', 'member', 'user', 'reason')
+
+
+@messages.Event.register
+class ReadOnlySet(messages.Event):
+    name = 'readonly.set'
+    __slots__ = ('channel', 'enable', 'user', 'reason')
+
+
+@messages.Event.register
+class MemberBanned(messages.Event):
+    name = 'ban'
+    __slots__ = ('user', 'member', 'reason')
+
+
+@messages.Event.register
+class MemberUnbanned(messages.Event):
+    name = 'unban'
+    __slots__ = ('user', 'member', 'reason')
+
 # ============================================================================
 
 def settings_loader(data):
-    mute = {}
-    for member_id, member_mutes in data.get('mute', {}).items():
-        mute[int(member_id)] = {int(channel_id): expiration
-                                for channel_id, expiration in member_mutes.items()}
-    data['mute'] = mute
+    # Mutes used to be stored in settings, convert them for migration
+    if 'mute' in data:
+        data['mute'] = {
+            int(member_id): {int(channel_id): expiration
+                             for channel_id, expiration in member_mutes.items()}
+            for member_id, member_mutes in data['mute'].items()
+        }
     return data
 
+db.settings.register(SETTINGS_KEY, settings_loader)
+
+def now():
+    return datetime.datetime.utcnow().timestamp()
+
 # ============================================================================
-# User mute feature
+# In-memory guild state
 
-async def get_channel_mutes(channel):
-    guild = channel.guild
-    settings = await db.settings.get(SETTINGS_KEY, channel.guild, loader=settings_loader)
-    mutes = settings['mute']
+class GuildState(object):
+    """ Moderation state of a guild, indexed for lookups from message handlers
 
-    timestamp = datetime.datetime.utcnow().timestamp()
+        Message handlers can tell a message needs no enforcement with two set
+        lookups: its channel is neither in readonly nor a key of mutes.
+    """
+    __slots__ = ('guild_id', 'readonly', 'mutes', 'overwrites')
 
-    return [(guild.get_member(user_id), channel_list[channel.id] - timestamp)
-            for user_id, channel_list in mutes.items()
-            if channel.id in channel_list and channel_list[channel.id] > timestamp]
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.readonly = frozenset()     # channel ids
+        self.mutes = {}                 # channel_id => {member_id: expiration}
+        self.overwrites = {}            # (channel_id, member_id) => previous send_messages
 
-async def get_channel_member_muted(channel, member):
-    settings = await db.settings.get(SETTINGS_KEY, channel.guild, loader=settings_loader)
-    mutes = settings['mute']
+    def is_muted(self, channel_id, member_id):
+        expiration = self.get_mute(channel_id, member_id)
+        return expiration is not None and expiration > now()
 
-    timestamp = datetime.datetime.utcnow().timestamp()
+    def get_mute(self, channel_id, member_id):
+        """ Return mute expiration, or None if member is not muted on channel """
+        channel_mutes = self.mutes.get(channel_id)
+        return channel_mutes.get(member_id) if channel_mutes else None
 
+    def add_mute(self, channel_id, member_id, expiration):
+        self.mutes.setdefault(channel_id, {})[member_id] = expiration
+
+    def remove_mute(self, channel_id, member_id):
+        """ Remove mute and return its expiration, or None if there was none """
+        channel_mutes = self.mutes.get(channel_id)
+        if not channel_mutes:
+            return None
+        expiration = channel_mutes.pop(member_id, None)
+        if not channel_mutes:
+            del self.mutes[channel_id]
+        return expiration
+
+
+_states = {}
+_loading = singleflight.SingleFlight()
+_generations = generation.Generations()
+
+def peek_state(guild):
+    """ Return moderation state of guild if it is loaded, None otherwise """
+    return _states.get(guild.id)
+
+async def get_state(guild):
+    """ Return moderation state of guild, loading it if needed """
     try:
-        member_mutes = mutes[member.id]
-    except KeyError:
-        return False
-    try:
-        expiration = member_mutes[channel.id]
+        return _states[guild.id]
     except KeyError:
-        return False
+        pass
+    return await _loading.load(guild.id, _load_state, guild)
+
+async def _load_state(guild):
+    mark = _generations.mark()
+    query = models.Mute.select().where(models.Mute.c.guild_id==guild.id)
 
-    if expiration < timestamp:
-        del member_mutes[channel.id]
-        if not member_mutes:
-            del mutes[member.id]
+    state = GuildState(guild.id)
+    async with await db.connection() as conn:
+        async for row in conn.execute(query):
+            _add_row(state, row)
+    await _load_settings(guild, state)
+
+    if not _generations.changed(guild.id, mark):    # do not cache data invalidated while loading
+        _states[guild.id] = state
+        expiry.push_state(state)
+    return state
+
+def _add_row(state, row):
+    state.add_mute(row['channel_id'], row['member_id'], row['expires_at'])
+    if row['overwritten']:
+        state.overwrites[(row['channel_id'], row['member_id'])] = row['previous']
+
+async def _load_settings(guild, state):
+    """ Load readonly channels, and move mutes still stored in settings to the mute table """
+    settings = await db.settings.get(SETTINGS_KEY, guild, loader=settings_loader)
+    state.readonly = frozenset(settings.get('readonly', ()))
+
+    with settings.modify():
+        legacy = settings.pop('mute', None)
+        if legacy is None:
+            return
+
+        rows = [
+            {'guild_id': guild.id, 'channel_id': channel_id,
+             'member_id': member_id, 'expires_at': int(expiration)}
+            for member_id, member_mutes in legacy.items()
+            for channel_id, expiration in member_mutes.items()
+            if state.get_mute(channel_id, member_id) is None
+        ]
+        if rows:
+            query = db.postgresql.insert(models.Mute).values(rows).on_conflict_do_nothing()
+            async with await db.connection() as conn:
+                await conn.execute(query)
+            for row in rows:
+                state.add_mute(row['channel_id'], row['member_id'], row['expires_at'])
         await settings.save()
-        return False
 
+async def warm_up(guilds):
+    """ Bulk-load moderation state of all given guilds """
+    guilds = [guild for guild in guilds if guild.id not in _states]
+    if not guilds:
+        return
+    mark = _generations.mark()
+
+    states = {guild.id: GuildState(guild.id) for guild in guilds}
+    query = models.Mute.select().where(db.any_of(models.Mute.c.guild_id, states))
+    async with await db.connection() as conn:
+        async for row in conn.execute(query):
+            _add_row(states[row['guild_id']], row)
+
+    for guild in guilds:
+        await _load_settings(guild, states[guild.id])
+    for guild in guilds:
+        state = states[guild.id]
+        if _generations.changed(guild.id, mark):
+            # Invalidated while loading, load it again so its mutes get scheduled
+            await get_state(guild)
+        elif _states.setdefault(guild.id, state) is state:
+            expiry.push_state(state)
+
+def forget_guild(guild_id):
+    """ Drop state of guild_id, or of all guilds if None """
+    _generations.invalidate(guild_id)
+    if guild_id is None:
+        _loading.clear()
+        _states.clear()
+    else:
+        _loading.forget(guild_id)
+        _states.pop(guild_id, None)
+
+def _settings_changed(guild_id, app):
+    if app is None or app == SETTINGS_KEY:
+        forget_guild(guild_id)
+
+db.invalidation.register(models.Mute.name, lambda guild_id, app: forget_guild(guild_id))
+db.invalidation.register(db.SettingsTable.name, _settings_changed)
+
+async def _delete_mutes(guild_id, channel_id, member_ids):
+    query = models.Mute.delete().where(models.Mute.c.guild_id==guild_id) \
+                                .where(models.Mute.c.channel_id==channel_id) \
+                                .where(db.any_of(models.Mute.c.member_id, member_ids))
+    async with await db.connection() as conn:
+        async with conn.begin():
+            await conn.execute(query)
+            await db.invalidation.notify(conn, models.Mute.name, [(guild_id, None)])
+
+# ============================================================================
+# Enforcement through permission overwrites
+
+def use_overwrites(channel):
+    """ Tell whether restrictions on channel should be enforced with permission overwrites
+        Otherwise, or if it fails, messages are deleted as they are posted.
+    """
+    enabled = (conf.settings.get('moderation') or {}).get('overwrites', False)
+    return enabled and channel.permissions_for(channel.guild.me).manage_roles
+
+async def deny_send(channel, target, reason=None):
+    """ Deny send_messages to target on channel, return its previous value """
+    overwrite = channel.overwrites_for(target)
+    previous = overwrite.send_messages
+    overwrite.send_messages = False
+    await channel.set_permissions(target, overwrite=overwrite, reason=reason)
+    return previous
+
+async def restore_send(channel, target, previous, reason=None):
+    """ Put back send_messages value saved by deny_send """
+    overwrite = channel.overwrites_for(target)
+    overwrite.send_messages = previous
+    await channel.set_permissions(target, overwrite=None if overwrite.is_empty() else overwrite,
+                                  reason=reason)
+
+async def _restore_mute(channel, member, previous):
+    """ Restore permissions of a muted member, return whether it succeeded """
+    try:
+        await restore_send(channel, member, previous, reason='mute lifted')
+    except discord.HTTPException as exc:
+        logger.warning('could not restore permissions of %s in channel %s: %s',
+                       member.id, channel.id, exc)
+        return False
     return True
 
+# ============================================================================
+# User mute feature
+
+async def get_channel_mutes(channel):
+    guild = channel.guild
+    state = await get_state(guild)
+    timestamp = now()
+
+    return [(guild.get_member(member_id), expiration - timestamp)
+            for member_id, expiration in state.mutes.get(channel.id, {}).items()
+            if expiration > timestamp]
+
+async def get_channel_member_muted(channel, member):
+    state = await get_state(channel.guild)
+    # Expired mutes are removed by the expiry scheduler, never from here
+    return state.is_muted(channel.id, member.id)
+
 async def add_channel_mutes(channel, members, duration, **context):
-    settings = await db.settings.get(SETTINGS_KEY, channel.guild, loader=settings_loader)
-    mutes = settings['mute']
+    guild = channel.guild
+    state = await get_state(guild)
+    expiration = int(now() + duration)
+
+    # Apply overwrites first, so stored mutes reflect what was actually done
+    overwrites = state.overwrites
+    if use_overwrites(channel):
+        for member in members:
+            if (channel.id, member.id) in overwrites:
+                continue    # already enforced, keep original previous value
+            try:
+                previous = await deny_send(channel, member, reason='muted')
+            except discord.HTTPException as exc:
+                logger.warning('could not deny %s in channel %s, deleting messages instead: %s',
+                               member.id, channel.id, exc)
+            else:
+                overwrites[(channel.id, member.id)] = previous
 
-    timestamp = int(datetime.datetime.utcnow().timestamp() + duration)
+    query = db.postgresql.insert(models.Mute).values([
+        {'guild_id': guild.id, 'channel_id': channel.id,
+         'member_id': member.id, 'expires_at': expiration,
+         'overwritten': (channel.id, member.id) in overwrites,
+         'previous': overwrites.get((channel.id, member.id))}
+        for member in members
+    ])
+    query = query.on_conflict_do_update(
+        index_elements=[models.Mute.c.guild_id, models.Mute.c.channel_id, models.Mute.c.member_id],
+        set_={'expires_at': query.excluded.expires_at,
+              'overwritten': query.excluded.overwritten,
+              'previous': query.excluded.previous},
+    )
+    async with await db.connection() as conn:
+        async with conn.begin():
+            await conn.execute(query)
+            await db.invalidation.notify(conn, models.Mute.name, [(guild.id, None)])
 
     for member in members:
-        mutes.setdefault(member.id, {})[channel.id] = timestamp
+        state.add_mute(channel.id, member.id, expiration)
+        expiry.push(guild.id, channel.id, member.id, expiration)
         messages.bus(member.guild).publish('mute.add',
             channel=channel, member=member, duration=duration,
             **context
         )
-    await settings.save()
 
 async def remove_channel_mutes(channel, members, **context):
-    settings = await db.settings.get(SETTINGS_KEY, channel.guild, loader=settings_loader)
-    mutes = settings['mute']
+    state = await get_state(channel.guild)
+    timestamp = now()
 
-    timestamp = datetime.datetime.utcnow().timestamp()
-
-    dirty = False
+    removed = []
     for member in members:
-        try:
-            member_mutes = mutes[member.id]
-        except KeyError:
-            continue
-        try:
-            expiration = member_mutes[channel.id]
-        except KeyError:
+        expiration = state.get_mute(channel.id, member.id)
+        if expiration is None:
             continue
-        del member_mutes[channel.id]
-        dirty = True
-
-        if not member_mutes:
-            del mutes[member.id]
+        key = (channel.id, member.id)
+        if key in state.overwrites and not await _restore_mute(channel, member, state.overwrites[key]):
+            continue    # keep the mute and its previous value, so lifting it can be retried
+        state.remove_mute(channel.id, member.id)
+        state.overwrites.pop(key, None)
+        removed.append(member.id)
         if expiration > timestamp:
             messages.bus(member.guild).publish('mute.remove', channel=channel, member=member, **context)
-    if dirty:
-        await settings.save()
+    if removed:
+        await _delete_mutes(channel.guild.id, channel.id, removed)
+
+async def reschedule_member(member):
+    """ Lift expired mutes of a member that could not be lifted while they were away """
+    state = await get_state(member.guild)
+    timestamp = now()
+    for channel_id, channel_mutes in state.mutes.items():
+        expiration = channel_mutes.get(member.id)
+        if expiration is not None and expiration <= timestamp:
+            expiry.push(member.guild.id, channel_id, member.id, expiration)
+
+# ============================================================================
+# Mute expiration
+
+class MuteExpiry(object):
+    """ Scheduler that lifts mutes at their deadline
+
+        Deadlines are kept in a min-heap. Entries are left in the heap when a mute
+        is lifted or extended, and discarded when they pop if they no longer match
+        guild state. Due mutes are removed from the database in a single statement
+        per batch, and a mute.remove event is published for each of them.
+        Mutes that could not be lifted are pushed back to be retried after
+        retry_delay seconds, keeping their stored expiration.
+    """
+    retry_delay = 60
+
+    def __init__(self):
+        self.client = None
+        self.heap = []
+        self.timer = None
+        self.task = None
+
+    def start(self, client):
+        self.client = client
+        self._arm()
+
+    def push(self, guild_id, channel_id, member_id, expiration, at=None):
+        """ Schedule a mute to be lifted at given time, defaulting to its expiration """
+        entry = (expiration if at is None else at, expiration, guild_id, channel_id, member_id)
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self._arm()
+
+    def push_state(self, state):
+        """ Schedule all mutes of a freshly loaded guild state """
+        for channel_id, channel_mutes in state.mutes.items():
+            for member_id, expiration in channel_mutes.items():
+                heapq.heappush(self.heap, (expiration, expiration, state.guild_id,
+                                           channel_id, member_id))
+        self._arm()
+
+    def _arm(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.client is None or self.task is not None or not self.heap:
+            return
+        delay = max(self.heap[0][0] - now(), 0)
+        self.timer = self.client.loop.call_later(delay, self._fire)
+
+    def _fire(self):
+        self.timer = None
+        self.task = tasks.supervisor.spawn(self.expire(), 'expiry')
+
+    async def expire(self):
+        """ Lift all mutes that are due """
+        try:
+            timestamp = now()
+            entries = []
+            while self.heap and self.heap[0][0] <= timestamp:
+                entries.append(heapq.heappop(self.heap))
+
+            due = []
+            for _, expiration, guild_id, channel_id, member_id in entries:
+                guild = self.client.get_guild(guild_id)
+                if guild is None:
+                    continue    # not on that guild anymore
+                try:
+                    state = await get_state(guild)  # dropped on invalidation, reload it
+                except Exception:
+                    logger.exception('could not load moderation state of guild %s', guild_id)
+                    self._retry(guild_id, channel_id, member_id, expiration)
+                    continue
+                if state.get_mute(channel_id, member_id) != expiration:
+                    continue    # lifted or extended
+
+                # The stored previous value is only dropped once the overwrite is restored
+                key = (channel_id, member_id)
+                channel = guild.get_channel(channel_id)
+                member = guild.get_member(member_id)
+                if key in state.overwrites and channel is not None:
+                    if member is None:
+                        continue    # restored when the member comes back, see reschedule_member
+                    if not await _restore_mute(channel, member, state.overwrites[key]):
+                        self._retry(guild_id, channel_id, member_id, expiration)
+                        continue
+                state.remove_mute(channel_id, member_id)
+                state.overwrites.pop(key, None)
+                due.append((guild_id, channel_id, member_id, expiration))
+            if not due:
+                return
+
+            try:
+                deleted = await _delete_expired(due)
+            except Exception:
+                logger.exception('could not delete %d expired mutes', len(due))
+                # Overwrites are restored already, put mutes back so rows get deleted later
+                for guild_id, channel_id, member_id, expiration in due:
+                    state = _states.get(guild_id)
+                    if state is not None:
+                        state.add_mute(channel_id, member_id, expiration)
+                    self._retry(guild_id, channel_id, member_id, expiration)
+                return
+
+            # Other instances sharing the database lift the same mutes,
+            # only the one that actually deleted a row announces it
+            for mute in due:
+                if mute not in deleted:
+                    continue
+                guild = self.client.get_guild(mute[0])
+                channel = guild and guild.get_channel(mute[1])
+                member = guild and guild.get_member(mute[2])
+                if channel and member:
+                    messages.bus(guild).publish('mute.remove', channel=channel, member=member,
+                                                user=guild.me, reason='expired')
+        finally:
+            self.task = None
+            self._arm()
+
+    def _retry(self, guild_id, channel_id, member_id, expiration):
+        heapq.heappush(self.heap, (now() + self.retry_delay, expiration,
+                                   guild_id, channel_id, member_id))
+
+expiry = MuteExpiry()
+
+async def _delete_expired(mutes):
+    """ Delete a batch of (guild_id, channel_id, member_id, expires_at) mutes
+        Return the set of those that were actually deleted.
+    """
+    columns = (models.Mute.c.guild_id, models.Mute.c.channel_id,
+               models.Mute.c.member_id, models.Mute.c.expires_at)
+    query = models.Mute.delete().where(db.tuple_(*columns).in_(mutes)).returning(*columns)
+    deleted = set()
+    async with await db.connection() as conn:
+        async with conn.begin():
+            async for row in conn.execute(query):
+                deleted.add(tuple(row))
+            if deleted:
+                await db.invalidation.notify(conn, models.Mute.name,
+                                             [(guild_id, None) for guild_id in set(mute[0] for mute in deleted)])
+    return deleted
 
 # ============================================================================
 # Readonly channel feature
 
 async def get_readonly(channel):
-    settings = await db.settings.get(SETTINGS_KEY, channel.guild, loader=settings_loader)
-    return channel.id in settings.setdefault('readonly', [])
+    state = await get_state(channel.guild)
+    return channel.id in state.readonly
 
 async def set_readonly(channel, enable, **context):
     settings = await db.settings.get(SETTINGS_KEY, channel.guild, loader=settings_loader)
@@ -110,9 +492,35 @@ async def set_readonly(channel, enable, **context):
     if enable and not channel.permissions_for(channel.guild.me).manage_messages:
         raise BotPermissionDenied()
 
-    if enable:
-        settings['readonly'].append(channel.id)
-    else:
-        settings['readonly'].remove(channel.id)
-    await settings.save()
+    # Keep settings from being reloaded while awaiting the REST calls, until saved
+    with settings.modify():
+        # Overwrites are keyed by channel id as a string, as json has no integer keys
+        overwrites = settings.setdefault('readonly_overwrites', {})
+        role = channel.guild.default_role
+        if enable:
+            settings['readonly'].append(channel.id)
+            if use_overwrites(channel):
+                try:
+                    previous = await deny_send(channel, role, reason='readonly')
+                except discord.HTTPException as exc:
+                    logger.warning('could not deny channel %s, deleting messages instead: %s',
+                                   channel.id, exc)
+                else:
+                    # A value left by a failed restore is the original one, keep it
+                    overwrites.setdefault(str(channel.id), previous)
+        else:
+            settings['readonly'].remove(channel.id)
+            if str(channel.id) in overwrites:
+                try:
+                    await restore_send(channel, role, overwrites[str(channel.id)],
+                                       reason='readonly lifted')
+                except discord.HTTPException as exc:
+                    logger.warning('could not restore permissions in channel %s: %s',
+                                   channel.id, exc)
+                else:
+                    del overwrites[str(channel.id)]
+        state = peek_state(channel.guild)
+        if state is not None:
+            state.readonly = frozenset(settings['readonly'])
+        await settings.save()
     messages.bus(channel.guild).publish('readonly.set', channel=channel, enable=enable, **context)
@@ -7,6 +7,7 @@ import asyncio
 import discord
 import logging
 import shlex
+import weakref
 from mantabot import messages
 
 logger = logging.getLogger(__name__)
@@ -14,11 +15,17 @@ logger = logging.getLogger(__name__)
 class PermissionDenied(RuntimeError):
     pass
 
+@messages.Event.register
+class CommandRun(messages.Event):
+    name = 'command.run'
+    __slots__ = ('command', 'invoked_name', 'args', 'message', 'user')
+
 # ============================================================================
 
 class Command(object):
     """ Single abstract command, inherited by commands """
     name = None
+    aliases = ()
     errors = None
 
     def __init__(self, group, client, output):
@@ -48,6 +55,7 @@ class CommandGroup(object):
     def __init__(self, name, register=True):
         self.name = name
         self.commands = {}
+        self.dispatchers = weakref.WeakSet()    # dispatchers routing to this group
         if register:
             CommandGroup.registry.append(self)
 
@@ -59,6 +67,8 @@ class CommandGroup(object):
     def register(self, command):
         """ decorator to register commands onto this command group """
         self.commands[command.name] = command
+        for dispatcher in self.dispatchers:
+            dispatcher.add_route(self, command)
         logger.debug('registered command %s -> %s' % (self.name, command.name))
         return command
 
@@ -83,7 +93,7 @@ class CommandGroup(object):
             args=' '.join(shlex.quote(arg) for arg in args),
         ))
         messages.bus(message.channel.guild).publish('command.run', command=command,
-                                                    name=name, args=args,
+                                                    invoked_name=name, args=args,
                                                     message=message, user=message.author)
 
         try:
@@ -2,21 +2,73 @@ import json
 from collections import namedtuple
 from mantabot import db
 from mantabot.command import command, dispatcher, models, reply
+from mantabot.util import generation, singleflight
+
+SETTINGS_KEY = 'command'
+
+db.settings.register(SETTINGS_KEY)
 
 # ============================================================================
 
 Entry = namedtuple('Entry', 'group_name role channels settings')
 
 
+class GuildPermissions(object):
+    """ Command permissions of a guild, compiled for lookups
+
+        Entries are indexed by (group_name, channel_id), with channel_id None for
+        entries that apply to all channels. Each key maps role ids to the first
+        entry granting that role, along with its position so that lookups through
+        both the channel and wildcard keys still honor entry order.
+    """
+    __slots__ = ('entries', 'index')
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.index = {}
+        for position, entry in enumerate(entries):
+            for channel_id in entry.channels or (None,):
+                roles = self.index.setdefault((entry.group_name, channel_id), {})
+                roles.setdefault(entry.role, (position, entry))
+
+    def get_entry(self, group_name, channel_id, role_ids):
+        """ Return first entry for group in channel granted to any of role_ids """
+        found = None
+        for key in ((group_name, channel_id), (group_name, None)):
+            roles = self.index.get(key)
+            if not roles:
+                continue
+            for role_id in roles.keys() & role_ids:
+                candidate = roles[role_id]
+                if found is None or candidate[0] < found[0]:
+                    found = candidate
+        return found[1] if found else None
+
+
 class DBDispatcher(dispatcher.Dispatcher):
     """ A dispatcher that stores command configuration in the database """
 
+    warm_up_batch = 1000    # guilds per query when warming up
+
     def __init__(self, *args, **kwargs):
         super(DBDispatcher, self).__init__(*args, **kwargs)
         self.guilds = {}
+        self.loading = singleflight.SingleFlight()
+        self.generations = generation.Generations()
+        db.invalidation.register(models.CommandPermission.name, self.on_notify)
+        db.invalidation.register(db.SettingsTable.name, self.on_settings_notify)
         group = command_group.clone()
         group.dispatcher = self
-        self.groups.append(group)
+        self.add_group(group)
+
+    async def get_prefixes(self, guild):
+        """ Return command prefixes configured for guild """
+        settings = await db.settings.get(SETTINGS_KEY, guild)
+        return settings.get('prefixes') or self.prefixes
+
+    async def on_guild_remove(self, guild):
+        self.clear_cache(guild)
+        self.clear_prefixes(guild.id)
 
     async def check_permissions(self, message, group, name):
         """ Raise command.PermissionDenied to prevent user from running command """
@@ -39,45 +91,88 @@ class DBDispatcher(dispatcher.Dispatcher):
             return self.guilds[guild.id]
         except KeyError:
             pass
+        return await self.loading.load(guild.id, self._load_guild, guild.id)
 
+    async def _load_guild(self, guild_id):
+        mark = self.generations.mark()
         query = models.CommandPermission.select().where(
-            models.CommandPermission.c.guild_id==guild.id
-        )
+            models.CommandPermission.c.guild_id==guild_id
+        ).order_by(models.CommandPermission.c.permission_id)
 
         entries = []
         async with await db.connection() as conn:
             async for row in conn.execute(query):
-                channels = row['channels'] or None
-                if channels is not None:
-                    channels = tuple(int(channel) for channel in channels.split(','))
-
-                settings = json.loads(row['settings'])
-                reply_class = settings.pop('reply_class', None)
-                if reply_class and hasattr(reply, reply_class):
-                    settings['reply_class'] = getattr(reply, reply_class)
-
-                entries.append(Entry(
-                    group_name=row['group_name'],
-                    role=row['role_id'],
-                    channels=channels,
-                    settings=settings,
-                ))
-                
-        self.guilds[guild.id] = entries
-        return entries
+                entries.append(self.make_entry(row))
+
+        permissions = GuildPermissions(entries)
+        if not self.generations.changed(guild_id, mark):    # do not cache data invalidated while loading
+            self.guilds[guild_id] = permissions
+        return permissions
+
+    async def warm_up(self, guilds):
+        """ Bulk-load configuration of all given guilds """
+        guild_ids = [guild.id for guild in guilds if guild.id not in self.guilds]
+        if not guild_ids:
+            return
+        mark = self.generations.mark()
+
+        loaded = {guild_id: [] for guild_id in guild_ids}
+        async with await db.connection() as conn:
+            for idx in range(0, len(guild_ids), self.warm_up_batch):
+                query = models.CommandPermission.select().where(db.any_of(
+                    models.CommandPermission.c.guild_id, guild_ids[idx:idx + self.warm_up_batch]
+                )).order_by(models.CommandPermission.c.permission_id)
+                async for row in conn.execute(query):
+                    loaded[row['guild_id']].append(self.make_entry(row))
+
+        for guild_id, entries in loaded.items():
+            if not self.generations.changed(guild_id, mark):
+                self.guilds.setdefault(guild_id, GuildPermissions(entries))
+
+    @staticmethod
+    def make_entry(row):
+        """ Build configuration entry from a database row """
+        channels = row['channels'] or None
+        if channels is not None:
+            channels = tuple(int(channel) for channel in channels.split(','))
+
+        settings = json.loads(row['settings'])
+        reply_class = settings.pop('reply_class', None)
+        if reply_class and hasattr(reply, reply_class):
+            settings['reply_class'] = getattr(reply, reply_class)
+
+        return Entry(
+            group_name=row['group_name'],
+            role=row['role_id'],
+            channels=channels,
+            settings=settings,
+        )
 
     async def get_entry(self, channel, member, group):
         """ Locate a specific configuration entry for the triplet """
-        return next((
-            entry for entry in await self.get_guild(channel.guild)
-            if entry.group_name == group.name and
-               (not entry.channels or channel.id in entry.channels) and
-               any(role.id == entry.role for role in member.roles)
-            ), None
-        )
+        permissions = await self.get_guild(channel.guild)
+        return permissions.get_entry(group.name, channel.id,
+                                     {role.id for role in member.roles})
 
     def clear_cache(self, guild):
-        self.guilds.pop(guild.id, None)
+        self.clear_cache_id(guild.id)
+
+    def clear_cache_id(self, guild_id):
+        """ Drop cached configuration for guild_id, or for all guilds if None """
+        self.generations.invalidate(guild_id)
+        if guild_id is None:
+            self.loading.clear()
+            self.guilds.clear()
+        else:
+            self.loading.forget(guild_id)
+            self.guilds.pop(guild_id, None)
+
+    def on_notify(self, guild_id, app):
+        self.clear_cache_id(guild_id)
+
+    def on_settings_notify(self, guild_id, app):
+        if app is None or app == SETTINGS_KEY:
+            self.clear_prefixes(guild_id)
 
 # ============================================================================
 
@@ -105,7 +200,7 @@ class List(command.Command):
         else:
             groups = dispatcher.groups
         guild = message.channel.guild
-        entries = sorted(await dispatcher.get_guild(guild),
+        entries = sorted((await dispatcher.get_guild(guild)).entries,
                          key=lambda entry: (entry.role, entry.channels or ()))
         roles = dict((role.id, role) for role in guild.roles)
         channels = dict((channel.id, channel) for channel in guild.channels)
@@ -178,6 +273,7 @@ class Add(command.Command):
         async with await db.connection() as conn:
             async with conn.begin():
                 await conn.execute(query)
+                await db.invalidation.notify(conn, models.CommandPermission.name, [(guild.id, None)])
         dispatcher.clear_cache(guild)
 
         await self.send('ajouté')
@@ -231,6 +327,42 @@ class Remove(command.Command):
         async with await db.connection() as conn:
             async with conn.begin():
                 await conn.execute(query)
+                await db.invalidation.notify(conn, models.CommandPermission.name, [(guild.id, None)])
         dispatcher.clear_cache(guild)
 
         await self.send('supprimé')
+
+
+@command_group.register
+class Prefix(command.Command):
+    """ Bot command that shows or sets command prefixes """
+    name = 'cmdprefix'
+
+    errors = {
+        'invalid': 'Invalid prefix: “{prefix}”',
+    }
+
+    messages = {
+        'prefixes': 'command prefixes: {prefixes}',
+    }
+
+    async def execute(self, message, args):
+        guild = message.channel.guild
+        dispatcher = self.group.dispatcher
+        settings = await db.settings.get(SETTINGS_KEY, guild)
+
+        if len(args) == 1 and args[0].lower() == 'reset':
+            settings.pop('prefixes', None)
+        elif args:
+            for prefix in args:
+                if not prefix or any(char.isspace() for char in prefix):
+                    return await self.error('invalid', prefix=prefix)
+            settings['prefixes'] = list(args)
+
+        if args:
+            await settings.save()
+            dispatcher.clear_prefixes(guild.id)
+
+        await self.send(self.messages['prefixes'].format(
+            prefixes=' '.join(settings.get('prefixes') or dispatcher.prefixes),
+        ))
@@ -1,7 +1,8 @@
 import asyncio
 import discord
-import shlex
-from mantabot.command import command, models, reply
+from mantabot import conf
+from mantabot.command import command, models, parser, reply
+from mantabot.core.discord import STOP
 
 # ============================================================================
 
@@ -10,15 +11,92 @@ class CommandError(Exception):
         self.message = msg
 
 
+class CommandMatcher(object):
+    """ Trie of every prefix + command name combination
+
+        Tells in a single walk over the first characters of a message whether it
+        addresses one of our commands, so other messages are discarded cheaply.
+    """
+    __slots__ = ('root',)
+    separators = frozenset(' \t\r\n')
+
+    def __init__(self, prefixes, names):
+        self.root = {}
+        for prefix in prefixes:
+            for name in names:
+                node = self.root
+                for char in (prefix + name).lower():
+                    node = node.setdefault(char, {})
+                node[None] = (len(prefix), name)    # None key marks a complete command
+
+    def match(self, content):
+        """ Return (prefix length, command name) for the longest match, or None """
+        found, node, separators = None, self.root, self.separators
+        for idx, char in enumerate(content):
+            node = node.get(char.lower())
+            if node is None:
+                break
+            if None in node and (idx + 1 == len(content) or content[idx + 1] in separators):
+                found = node[None]
+        return found
+
+
 class Dispatcher(object):
-    """ Bot plugin that dispatches user commands to command groups. """
+    """ Bot plugin that dispatches user commands to command groups.
+        Messages that run a command are not propagated to next handlers.
+    """
 
-    prefixes = tuple('!#')      # only messages starting with those are used
+    prefixes = tuple('!#')      # default command prefixes
     delete_errors_after = 5     # basic error messages are deleted after that much time
 
     def __init__(self, client, groups=None):
         self.client = client
-        self.groups = list(groups or command.CommandGroup.registry)
+        self.groups = []
+        self.routes = {}    # command name or alias => (group, command class)
+        self.matchers = {}  # guild id => CommandMatcher
+        self.compiled = {}  # sorted prefix tuple => CommandMatcher, shared by guilds
+        for group in (groups or command.CommandGroup.registry):
+            self.add_group(group)
+
+    def add_group(self, group):
+        """ Attach a command group, routing its commands """
+        self.groups.append(group)
+        group.dispatchers.add(self)
+        for klass in group.commands.values():
+            self.add_route(group, klass)
+
+    def add_route(self, group, klass):
+        """ Route command name and aliases to group - raise on conflict with another group """
+        for name in (klass.name,) + tuple(klass.aliases):
+            name = name.lower()
+            existing = self.routes.get(name)
+            if existing is not None and existing[0] is not group:
+                raise conf.ConfigurationError('command %s of group %s conflicts with group %s'
+                                              % (name, group.name, existing[0].name))
+            self.routes[name] = (group, klass)
+        self.matchers.clear()
+        self.compiled.clear()
+
+    async def get_prefixes(self, guild):
+        """ Return command prefixes used in guild """
+        return self.prefixes
+
+    async def get_matcher(self, guild):
+        """ Return the command matcher for guild, compiling it if needed """
+        prefixes = tuple(sorted(set(await self.get_prefixes(guild))))
+        try:
+            matcher = self.compiled[prefixes]
+        except KeyError:
+            matcher = self.compiled[prefixes] = CommandMatcher(prefixes, self.routes)
+        self.matchers[guild.id] = matcher
+        return matcher
+
+    def clear_prefixes(self, guild_id):
+        """ Have guild prefixes reloaded on next message, for all guilds if None """
+        if guild_id is None:
+            self.matchers.clear()
+        else:
+            self.matchers.pop(guild_id, None)
 
     async def on_message(self, message):
         """ Called everytime the bot sees a message """
@@ -27,21 +105,23 @@ class Dispatcher(object):
         if not isinstance(message.channel, discord.abc.GuildChannel):
             return
 
-        # Only handle messages with correct prefix
-        if not message.content.startswith(self.prefixes):
-            return
+        # Only handle messages addressing one of our commands
+        matcher = self.matchers.get(message.channel.guild.id)
+        if matcher is None:
+            matcher = await self.get_matcher(message.channel.guild)
+        found = matcher.match(message.content)
+        if found is None:
+            return  # silently discard message, might be for another bot
 
         # Get name and arguments for command
         try:
-            name, args = self.parse_message(message)
+            name, args = self.parse_message(message, *found)
         except CommandError:
             return  # silently discard command, might be for another bot
 
         # Locate the command
-        try:
-            group = next(group for group in self.groups if name in group.commands)
-        except StopIteration:
-            return   # silently discard command, might be for another bot
+        group, klass = self.routes[name]
+        name = klass.name
 
         try:
             await self.check_permissions(message, group, name)
@@ -54,13 +134,19 @@ class Dispatcher(object):
         async with reply_class(self.client, message) as reply_obj:
             await self.dispatch_command(message, group, name, args,
                                         settings=settings, output=reply_obj)
-
-    def parse_message(self, message):
-        """ Split message into command name and arguments list """
+        return STOP     # command consumed the message, next handlers need not see it
+
+    def parse_message(self, message, prefix_length, name):
+        """ Split message into command name and arguments list
+            Only the first line is used, name is the command found by the matcher.
+        """
+        content = message.content
+        endpos = content.find('\n')
+        if endpos < 0:
+            endpos = len(content)
         try:
-            args = shlex.split(message.content[1:].split('\n', 1)[0])
-            name = args.pop(0).lower()
-        except (ValueError, IndexError):
+            args = parser.split(content, prefix_length + len(name), endpos)
+        except ValueError:
             raise CommandError('invalid command format')
         return name, args
 
@@ -0,0 +1,53 @@
+""" Command line tokenizer
+
+Splits command lines with the same rules as shlex.split in POSIX mode, matching
+whole runs of characters with regular expressions instead of lexing them one
+character at a time.
+"""
+import re
+
+_PIECE = re.compile(r'''
+    (?P<plain>[^ \t\r\n'"\\]+)
+  | \\(?P<escaped>.)
+  | '(?P<single>[^']*)'
+  | "(?P<double>(?:[^"\\]|\\.)*)"
+  | (?P<space>[ \t\r\n]+)
+''', re.VERBOSE | re.DOTALL)
+
+# Within double quotes, backslash only escapes double quotes and itself
+_DOUBLE_ESCAPE = re.compile(r'\\(["\\])')
+
+
+def split(text, pos=0, endpos=None):
+    """ Split text[pos:endpos] into a list of arguments
+        Raise ValueError on missing closing quotation or escaped character.
+    """
+    endpos = len(text) if endpos is None else endpos
+    tokens, current = [], None
+
+    while pos < endpos:
+        match = _PIECE.match(text, pos, endpos)
+        if match is None:
+            if text[pos] == '\\':
+                raise ValueError('No escaped character')
+            raise ValueError('No closing quotation')
+        pos = match.end()
+
+        kind = match.lastgroup
+        if kind == 'space':
+            if current is not None:
+                tokens.append(''.join(current))
+                current = None
+            continue
+
+        value = match.group(kind)
+        if kind == 'double':
+            value = _DOUBLE_ESCAPE.sub(r'\1', value)
+        if current is None:
+            current = [value]
+        else:
+            current.append(value)
+
+    if current is not None:
+        tokens.append(''.join(current))
+    return tokens
@@ -1,6 +1,7 @@
 import asyncio
 import discord
 import logging
+from mantabot.core import tasks
 
 logger = logging.getLogger(__name__)
 
@@ -47,7 +48,7 @@ class DirectReply(Reply):
 
     async def send(self, *args, **kwargs):
         if isinstance(self.channel, discord.abc.GuildChannel):
-            asyncio.ensure_future(self.delete_message(self.message), loop=self.client.loop)
+            tasks.supervisor.spawn(self.delete_message(self.message), 'reply', self.guild)
         return await self.user.send(*args, **kwargs)
 
 
@@ -72,7 +73,7 @@ class DeleteAndMentionReply(MentionReply):
     async def error(self, text):
         message = await self.send(text)
         if isinstance(self.channel, discord.abc.GuildChannel):
-            asyncio.ensure_future(self.delete_after(message, 10), loop=self.client.loop)
+            tasks.supervisor.spawn(self.delete_after(message, 10), 'reply', self.guild)
         return message
 
     async def delete_after(self, message, delay):
@@ -1,26 +1,169 @@
-import asyncio, collections, discord, logging, sys, weakref
-from mantabot import conf
-from mantabot.core import messages, private
+import asyncio, collections, discord, logging, sys, time, weakref
+from mantabot import conf, db
+from mantabot.core import messages, private, stats, tasks
 
 logger = logging.getLogger(__name__)
 
+STOP = object()     # returned by an event handler, prevents next handlers from seeing the event
 
-class CancelContext(object):
+
+class CancelContext(tasks.TrackContext):
     """ Request that current task gets early cancellation from discord Client on shutdown """
-    def __init__(self, client):
+    def __init__(self, client, guild=None):
+        super().__init__(tasks.supervisor, 'event', guild)
+        self.client = client
+
+
+def event_guild_id(args):
+    """ Return the id of the guild an event relates to, or None """
+    for arg in args:
+        if isinstance(arg, discord.Guild):
+            return arg.id
+        guild = getattr(arg, 'guild', None)
+        if guild is not None:
+            return guild.id
+        guild_id = getattr(arg, 'guild_id', None)
+        if guild_id is not None:
+            return guild_id
+    return None
+
+
+# Events carrying the new state of an object, event name => index of that object in arguments.
+# A later event about the same object supersedes an earlier one still pending.
+SUPERSEDING_EVENTS = {
+    'on_message_edit': 1,
+    'on_member_update': 1,
+    'on_guild_update': 1,
+    'on_guild_channel_update': 1,
+    'on_guild_role_update': 1,
+    'on_voice_state_update': 0,
+}
+
+def event_target(event, args):
+    """ Return the id of the object a superseding event is about, or None """
+    index = SUPERSEDING_EVENTS.get(event)
+    if index is None or len(args) <= index:
+        return None
+    return getattr(args[index], 'id', None)
+
+
+class EventScheduler(object):
+    """ Bounded per-guild event queues, drained fairly by a pool of workers
+
+        Guilds with pending events take turns: a worker handles one event of a
+        guild, then puts the guild back at the end of the line. A guild is only
+        handled by one worker at a time, which keeps its events in order and
+        prevents a single busy guild from starving the others.
+
+        When a guild queue is full, the overflow policy applies:
+            - drop: discard the new event. Handlers never see it, so a dropped
+              message also escapes readonly and mute enforcement.
+            - coalesce: if the new event supersedes a pending one, such as a later
+              update of the same member or edit of the same message, it takes
+              its place. Otherwise, the new event is dropped.
+            - block: wait for room in the queue.
+    """
+    policies = ('drop', 'coalesce', 'block')
+
+    def __init__(self, client, workers=4, max_pending=100, overflow='drop'):
+        if overflow not in self.policies:
+            raise conf.ConfigurationError('Unknown overflow policy %s' % overflow)
         self.client = client
+        self.worker_count = workers
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.queues = {}    # guild_id => deque of (event, stages, args, kwargs, queued_at)
+        self.waiters = collections.defaultdict(collections.deque)
+        self.ready = None   # queue of guild ids waiting for a worker
+        self.workers = []
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        self.ready = asyncio.Queue(loop=self.client.loop)
+        self.workers = [tasks.supervisor.spawn(self.work(), 'scheduler')
+                        for _ in range(self.worker_count)]
 
-    def __enter__(self):
-        self.task = task = asyncio.Task.current_task()
-        self.client._close_tasks.append(task)
+    async def submit(self, guild_id, event, stages, args, kwargs):
+        """ Queue event for processing, applying overflow policy """
+        if not self.workers:
+            self.start()
+        queue = self.queues.get(guild_id)
+        while queue is not None and len(queue) >= self.max_pending:
+            if self.overflow == 'drop':
+                self.dropped += 1
+                return
+            if self.overflow == 'coalesce':
+                target = event_target(event, args)
+                for idx, item in enumerate(queue):
+                    if target is not None and item[0] == event and event_target(event, item[2]) == target:
+                        queue[idx] = (event, stages, args, kwargs, item[4])
+                        self.coalesced += 1
+                        return
+                self.dropped += 1
+                return
+            waiter = self.client.loop.create_future()
+            self.waiters[guild_id].append(waiter)
+            await waiter
+            queue = self.queues.get(guild_id)
 
-    def __exit__(self, exc_type, exc_value, tb):
-        ref = self.client._close_tasks
-        idx = ref.index(self.task)
-        if idx == len(ref) - 1:
-            ref.pop()
+        item = (event, stages, args, kwargs, time.monotonic())
+        if queue is None:
+            self.queues[guild_id] = collections.deque((item,))
+            self.ready.put_nowait(guild_id)
         else:
-            ref[idx] = ref.pop()
+            queue.append(item)
+
+    async def work(self):
+        while True:
+            guild_id = await self.ready.get()
+            queue = self.queues[guild_id]
+            event, stages, args, kwargs, queued_at = queue.popleft()
+            self._wake(guild_id)
+
+            wait = time.monotonic() - queued_at
+            self.wait_total += wait
+            if wait > self.wait_max:
+                self.wait_max = wait
+
+            try:
+                await self.client._dispatch(event, stages, args, kwargs, guild_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await self.client.on_error(event, *args, **kwargs)
+            finally:
+                self.processed += 1
+                if queue:
+                    self.ready.put_nowait(guild_id)
+                else:
+                    del self.queues[guild_id]
+                    self._wake(guild_id)
+
+    def _wake(self, guild_id):
+        waiters = self.waiters.get(guild_id)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+        if waiters is not None and not waiters:
+            del self.waiters[guild_id]
+
+    def stats(self):
+        return {
+            'guilds': len(self.queues),
+            'pending': sum(len(queue) for queue in self.queues.values()),
+            'depths': {guild_id: len(queue) for guild_id, queue in self.queues.items()},
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'wait_total': self.wait_total,
+            'wait_max': self.wait_max,
+        }
 
 
 class Client(discord.Client):
@@ -28,13 +171,108 @@ class Client(discord.Client):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self._close_tasks = []
         self._handlers = collections.OrderedDict()
+        self._events = {}           # event name => tuple of handler methods
+        self._forwarders = set()    # event names with a generated forwarder
+        self._handler_stats = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        options = conf.settings.get('scheduler')
+        self.scheduler = EventScheduler(self, **options) if options else None
+        if self.scheduler is not None:
+            stats.reporter.register('scheduler', self.scheduler.stats)
+        stats.reporter.register('handlers', self.handler_stats)
+        stats.reporter.register('bus', messages.stats)
         self.private_chats = weakref.WeakValueDictionary()
         self.initialized = False
 
     def add_handlers(self, handlers, **kwargs):
         self._handlers.update(handlers, **kwargs)
+        self._build_events()
+
+    def _collect_handlers(self, event):
+        """ Return dispatch stages for event, a tuple of tuples of (name, method)
+
+            Handlers run in order, one stage after another. Consecutive handlers
+            declaring `concurrent = True` share a stage, where they run together.
+        """
+        stages, last_concurrent = [], False
+        for name, handler in self._handlers.items():
+            method = getattr(handler, event, None)
+            if not asyncio.iscoroutinefunction(method):
+                continue
+            concurrent = getattr(handler, 'concurrent', False)
+            if concurrent and last_concurrent:
+                stages[-1].append((name, method))
+            else:
+                stages.append([(name, method)])
+            last_concurrent = concurrent
+        return tuple(tuple(stage) for stage in stages)
+
+    def _build_events(self):
+        """ Precompute event dispatch table, and register a forwarder for each event
+
+            Events that no handler implements get no forwarder, so discord.py does
+            not even schedule them.
+        """
+        names = set(key for handler in self._handlers.values()
+                        for key in dir(handler) if key.startswith('on_'))
+        self._events = {}
+        for name in names:
+            stages = self._collect_handlers(name)
+            if stages:
+                self._events[name] = stages
+
+        for name in self._forwarders:
+            delattr(self, name)
+        self._forwarders = set(name for name in self._events if not hasattr(type(self), name))
+        for name in self._forwarders:
+            setattr(self, name, self._make_forwarder(name, self._events[name]))
+
+    def _make_forwarder(self, event, stages):
+        async def forwarder(*args, **kwargs):
+            if self.scheduler is not None:
+                guild_id = event_guild_id(args)
+                if guild_id is not None:
+                    await self.scheduler.submit(guild_id, event, stages, args, kwargs)
+                    return
+            await self._dispatch(event, stages, args, kwargs)
+        forwarder.__name__ = event
+        return forwarder
+
+    async def _dispatch(self, event, stages, args, kwargs, guild_id=None):
+        """ Run handler stages for event, until one of them returns STOP """
+        with CancelContext(self, guild_id):
+            for stage in stages:
+                if len(stage) == 1:
+                    result = await self._run_handler(event, stage[0][0], stage[0][1], args, kwargs)
+                    if result is STOP:
+                        return
+                    continue
+
+                results = await asyncio.gather(*(
+                    self._run_handler(event, name, method, args, kwargs) for name, method in stage
+                ), loop=self.loop, return_exceptions=True)
+                for result in results:
+                    if isinstance(result, BaseException):
+                        raise result
+                if any(result is STOP for result in results):
+                    return
+
+    async def _run_handler(self, event, name, method, args, kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            stats = self._handler_stats[(name, event)]
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
+
+    def handler_stats(self):
+        """ Return {(handler name, event): {count, total, max}} latencies, in seconds """
+        return {key: {'count': count, 'total': total, 'max': maximum}
+                for key, (count, total, maximum) in self._handler_stats.items()}
 
     def get_handler(self, name):
         return self._handlers[name]
@@ -44,15 +282,14 @@ class Client(discord.Client):
         return CancelContext(self)
 
     async def close(self):
-        """ Cancel event _handlers before closing the connection.
+        """ Cancel event handlers and other supervised tasks before closing the connection.
             This lets them send some last instructions to discord before shutting down.
         """
         if self.is_closed():
             return
         await messages.bus().publish_sync('core.close', client=self)
-        gathered = asyncio.gather(*self._close_tasks, loop=self.loop, return_exceptions=True)
-        gathered.cancel()
-        for result in await gathered:
+        results = await tasks.supervisor.cancel(exclude=(asyncio.Task.current_task(),))
+        for result in results:
             if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
                 logger.error("exception at close: %r" % result)
         await super(Client, self).close()
@@ -68,13 +305,11 @@ class Client(discord.Client):
 
     async def _forward_event(self, event, *args, **kwargs):
         """ Internal helper to forward event to handlers outside of automatic event """
-        with CancelContext(self):
-            for handler in self._handlers.values():
-                try:
-                    handler = getattr(handler, event)
-                except AttributeError:
-                    continue
-                await handler(*args, **kwargs)
+        try:
+            stages = self._events[event]
+        except KeyError:
+            stages = self._events[event] = self._collect_handlers(event)
+        await self._dispatch(event, stages, args, kwargs)
 
     async def on_ready(self):
         """ Called when discord api is ready """
@@ -87,9 +322,18 @@ class Client(discord.Client):
         for guild in self.guilds:
             logger.info('    -> on guild %s [%s]', guild.name, guild.id)
 
+        await self.warm_up()
         await self._forward_event('on_ready')
         messages.bus().publish('core.ready', client=self)
 
+    async def warm_up(self):
+        """ Bulk-load caches for all connected guilds before handlers get ready """
+        try:
+            await db.settings.prefetch(guild.id for guild in self.guilds)
+            await self._forward_event('warm_up', self.guilds)
+        except Exception:
+            logger.exception('cache warm-up failed, loading lazily')
+
     async def on_error(self, event, *args, **kwargs):
         if conf.settings.get('debug', False):
             logger.exception('discord error in event: %s' % event)
@@ -99,26 +343,5 @@ class Client(discord.Client):
 
     async def on_guild_remove(self, guild):
         await self._forward_event('on_guild_remove', guild)
-        messages.destroy_bus(key=guild)
-
-    def __getattr__(self, key):
-        """ Generate automatic forwarding of events to plugins as requested
-
-            This automatically generates an event handler, that loops through
-            self._handlers and invokes the matching handler if it exists.
-        """
-        if key.startswith('on_'):
-            async def caller(client, *args, **kwargs):
-                with CancelContext(client):
-                    for handler in client._handlers.values():
-                        try:
-                            method = getattr(handler, key)
-                        except AttributeError:
-                            continue
-                        await method(*args, **kwargs)
-            caller.__name__ = key
-            method = caller.__get__(self)
-            setattr(self, key, method)
-            return method
-        raise AttributeError("'%s' object has no attribute '%s'"
-                             % (self.__class__.__name__, key))
+        messages.destroy_bus(key=guild.id)
+        db.settings.invalidate_guild(guild)
@@ -1,4 +1,5 @@
-import asyncio, collections, logging
+import asyncio, collections, logging, time, weakref
+from mantabot.core import tasks
 
 logger = logging.getLogger(__name__)
 
@@ -12,64 +13,323 @@ def event_handler(name, **filters):
     return decorator
 
 
+class Event(object):
+    """ Base class for bus events
+
+        Subclasses set a name and list their fields in __slots__. Events are
+        allocated once per publication and shared by all subscribers, which must
+        treat them as read-only. Fields not given when publishing are None.
+    """
+    __slots__ = ()
+    name = None
+    types = {}      # event name => event class
+
+    @classmethod
+    def register(cls, klass):
+        cls.types[klass.name] = klass
+        return klass
+
+    def __init__(self, **fields):
+        for key in self.__slots__:
+            setattr(self, key, fields.pop(key, None))
+        if fields:
+            raise TypeError('%s got unexpected fields %s' % (type(self).__name__, ', '.join(fields)))
+
+    def __getitem__(self, key):
+        """ Allow events to be used as mappings, for instance in str.format_map """
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def items(self):
+        return ((key, getattr(self, key)) for key in self.__slots__)
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, ' '.join('%s=%r' % item for item in self.items()))
+
+
+class GenericEvent(Event):
+    """ Fallback for event names no class was registered for, fields are kept in a dict """
+    __slots__ = ('name', 'data')
+
+    def __init__(self, name, **data):
+        self.name = name
+        self.data = data
+
+    def __getattr__(self, key):
+        try:
+            return self.data[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def items(self):
+        return self.data.items()
+
+
+def make_event(name, **data):
+    """ Build an event of the class registered for name """
+    klass = Event.types.get(name)
+    if klass is None:
+        return GenericEvent(name, **data)
+    return klass(**data)
+
+
+@Event.register
+class CoreReady(Event):
+    name = 'core.ready'
+    __slots__ = ('client',)
+
+
+@Event.register
+class CoreClose(Event):
+    name = 'core.close'
+    __slots__ = ('client',)
+
+
+def compile_filters(filters):
+    """ Return a predicate testing event attributes against filters, None if there are none """
+    if not filters:
+        return None
+    items = tuple(filters.items())
+    if len(items) == 1:
+        (key, value), = items
+        return lambda event: getattr(event, key, None) == value
+    return lambda event: all(getattr(event, key, None) == value for key, value in items)
+
+
+class Subscription(object):
+    """ A subscribed handler, with its filters compiled into a predicate
+
+        The subscribed object is only referenced weakly: once it is garbage
+        collected, on_collect is called with the subscription.
+    """
+    __slots__ = ('obj', 'key', 'event', 'match', 'queue',
+                 'calls', 'errors', 'latency_total', 'latency_max', '__weakref__')
+
+    def __init__(self, obj, key, event, filters, queue=None, on_collect=None):
+        if on_collect is None:
+            self.obj = weakref.ref(obj)
+        else:
+            this = weakref.ref(self)
+            self.obj = weakref.ref(obj, lambda ref: this() and on_collect(this()))
+        self.key = key
+        self.event = event
+        self.match = compile_filters(filters)
+        self.queue = queue          # SubscriberQueue delivering events, None to run at once
+        self.calls = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    async def __call__(self, event):
+        obj = self.obj()
+        if obj is None:
+            return
+        start = time.perf_counter()
+        try:
+            await getattr(obj, self.key)(event)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self.latency_total += elapsed
+            if elapsed > self.latency_max:
+                self.latency_max = elapsed
+
+    def stats(self):
+        return {
+            'subscriber': type(self.obj()).__name__,
+            'handler': self.key,
+            'event': self.event,
+            'calls': self.calls,
+            'errors': self.errors,
+            'latency_total': self.latency_total,
+            'latency_max': self.latency_max,
+            'queued': len(self.queue) if self.queue is not None else None,
+            'dropped': self.queue.dropped if self.queue is not None else None,
+        }
+
+
+class SubscriberQueue(object):
+    """ Bounded queue of events for one subscriber, delivered in order by a single consumer
+
+        The consumer task only exists while events are pending. When the queue is
+        full, the overflow policy applies:
+            - drop_oldest: discard the oldest pending event and queue the new one.
+            - drop_newest: discard the new event.
+    """
+    policies = ('drop_oldest', 'drop_newest')
+
+    def __init__(self, bus, max_size=100, overflow='drop_oldest'):
+        if overflow not in self.policies:
+            raise ValueError('Unknown overflow policy %s' % overflow)
+        self.bus = bus
+        self.max_size = max_size
+        self.overflow = overflow
+        self.items = collections.deque()    # (subscription, event)
+        self.consumer = None
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, subscription, event):
+        if len(self.items) >= self.max_size:
+            self.dropped += 1
+            if self.overflow == 'drop_newest':
+                return
+            self.items.popleft()
+        self.items.append((subscription, event))
+        if self.consumer is None:
+            self.consumer = tasks.supervisor.spawn(self.consume(), 'bus', self.bus.name)
+
+    async def drain(self):
+        """ Wait until all pending events are delivered """
+        while self.consumer is not None:
+            await asyncio.shield(self.consumer, loop=self.bus.loop)
+
+    async def consume(self):
+        try:
+            while self.items:
+                subscription, event = self.items.popleft()
+                try:
+                    await subscription(event)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception('Exception while processing event %s', event.name)
+        finally:
+            self.consumer = None
+
+
 class MessageBus(object):
-    """ Lightweight, non-persistent, message bus """
+    """ Lightweight, non-persistent, message bus
+
+        Subscribers are held weakly: their subscriptions end when they are
+        garbage collected, so they need to be kept alive elsewhere.
+    """
 
     def __init__(self, name=None, loop=None):
         self.name = name
         self.loop = loop
-        self.subscribers = collections.defaultdict(list)
+        self.subscribers = {}       # event name => list of subscriptions, '*' for all events
+
+    def subscribe(self, obj, queue=None, overflow='drop_oldest'):
+        """ Automatically register all decorated event handlers on obj
 
-    def subscribe(self, obj):
-        """ Automatically register all decorated event handlers on obj """
+            If queue is set, events for obj go through a queue of that size, and
+            its handlers run one at a time, in publication order.
+        """
+        queue = SubscriberQueue(self, queue, overflow) if queue else None
         for key in dir(obj):
             value = getattr(obj, key)
             event_name = getattr(value, 'event_name', None)
             if event_name and callable(value):
-                self.subscribe_method(obj, key, event_name, **value.event_filters)
+                self.subscribe_method(obj, key, event_name, queue=queue, **value.event_filters)
         return obj
 
-    def subscribe_method(self, obj, key, event, **filters):
-        """ Subscribe object method """
+    def subscribe_method(self, obj, key, event, queue=None, **filters):
+        """ Subscribe object method, optionally delivering through a SubscriberQueue """
         if not asyncio.iscoroutinefunction(getattr(obj, key)):
             raise TypeError('Must pass an asynchronous method name')
-        self.subscribers[event].append((obj, key, filters))
+        subscription = Subscription(obj, key, event, filters, queue, on_collect=self._discard)
+        self.subscribers.setdefault(event, []).append(subscription)
 
     def unsubscribe(self, obj):
-        """ Cancal all subscribtions for given object """
-        for target in self.subscribers.values():
-            target[:] = (item for item in target if item[0] != obj)
+        """ Cancel all subscriptions for given object """
+        for event, target in list(self.subscribers.items()):
+            target[:] = (item for item in target if item.obj() is not obj)
+            if not target:
+                del self.subscribers[event]
 
-    async def publish_sync(self, event, **data):
-        """ Run all handlers for the event """
-        logger.debug('bus(%s): publish(%r, %s)' % (
-                     self.name, event, ', '.join('%s=%s' % (key, value) for key, value in data.items())))
-        tasks = [
-            getattr(subscriber[0], subscriber[1])(**data)
-            for subscriber in self.subscribers[event]
-            if all(data.get(key) == value for key, value in (subscriber[2] or {}).items())
-        ]
-        tasks.extend(
-            getattr(subscriber[0], subscriber[1])(event, **data)
-            for subscriber in self.subscribers['*']
-        )
-        if not tasks:
-            return
+    async def drain(self, obj):
+        """ Wait until events queued for obj are delivered """
+        queues = set(item.queue for target in self.subscribers.values() for item in target
+                     if item.queue is not None and item.obj() is obj)
+        for queue in queues:
+            await queue.drain()
+
+    def _discard(self, subscription):
+        target = self.subscribers.get(subscription.event)
+        if target is not None and subscription in target:
+            target.remove(subscription)
+            if not target:
+                del self.subscribers[subscription.event]
 
-        for task in asyncio.as_completed(tasks, loop=self.loop):
+    def count(self):
+        """ Return the number of subscriptions """
+        return sum(len(target) for target in self.subscribers.values())
+
+    def _match(self, event):
+        """ Return subscriptions matching the event, without running anything """
+        subscribers = self.subscribers
+        matched = [item for item in subscribers.get(event.name, ())
+                   if item.match is None or item.match(event)]
+        matched.extend(subscribers.get('*', ()))
+        return matched
+
+    def _enqueue(self, event, matched):
+        """ Hand event over to subscriber queues, return subscriptions to run directly """
+        direct = []
+        for item in matched:
+            if item.queue is None:
+                direct.append(item)
+            else:
+                item.queue.put(item, event)
+        return direct
+
+    def _prepare(self, event, data):
+        """ Return the event object and subscriptions to run directly, or None if there are none
+
+            Event objects are only built when some subscriber may want them.
+        """
+        if isinstance(event, str):
+            if event not in self.subscribers and '*' not in self.subscribers:
+                return None, None
+            event = make_event(event, **data)
+        matched = self._enqueue(event, self._match(event))
+        return event, matched or None
+
+    async def _run(self, event, matched):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('bus(%s): publish %r', self.name, event)
+
+        for task in asyncio.as_completed([item(event) for item in matched], loop=self.loop):
             try:
                 await task
             except Exception:
-                logger.exception('Exception while processing event %s', event)
+                logger.exception('Exception while processing event %s', event.name)
+
+    async def publish_sync(self, event, **data):
+        """ Run all handlers for the event, given as an Event or as a name and its fields """
+        event, matched = self._prepare(event, data)
+        if matched:
+            await self._run(event, matched)
 
     def publish(self, event, **data):
-        """ Schedule all handlers for that event, return the controlling task """
-        return asyncio.ensure_future(self.publish_sync(event, **data), loop=self.loop)
+        """ Schedule all handlers for that event, return the controlling task
+
+            The event is given as an Event or as a name and its fields. Returns
+            None without scheduling anything if no handler matches, or if all
+            matching handlers deliver through a queue.
+        """
+        event, matched = self._prepare(event, data)
+        if not matched:
+            return None
+        return tasks.supervisor.spawn(self._run(event, matched), 'bus', self.name)
+
+    def stats(self):
+        """ Return delivery statistics for all subscriptions """
+        return [item.stats() for target in self.subscribers.values() for item in target]
 
-_buses = {}
+_buses = {}     # guild id => bus, None for the global bus
 
 def bus(key=None):
-    global _buses
+    """ Return the bus for a guild, given as an object or an id, or the global bus """
+    key = getattr(key, 'id', key)
     try:
         obj = _buses[key]
     except KeyError:
@@ -77,8 +337,11 @@ def bus(key=None):
     return obj
 
 def destroy_bus(*, key):
-    global _buses
-    try:
-        del _buses[key]
-    except KeyError:
-        pass
+    _buses.pop(getattr(key, 'id', key), None)
+
+def stats():
+    """ Return the number of live buses and subscriptions on each of them """
+    return {
+        'buses': len(_buses),
+        'subscriptions': {key: obj.count() for key, obj in _buses.items()},
+    }
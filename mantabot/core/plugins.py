@@ -1,7 +1,7 @@
 import importlib
 from mantabot import conf
 
-AUTO_IMPORT = ('commands', 'models')
+AUTO_IMPORT = ('commands', 'management', 'models')
 
 class Plugin(object):
     def __init__(self, path):
@@ -1,5 +1,5 @@
 import asyncio, importlib, logging, os, signal
-from mantabot.core import discord, management
+from mantabot.core import discord, management, stats, tasks
 from mantabot import conf, db, session
 
 logger = logging.getLogger(__name__)
@@ -18,10 +18,18 @@ class Run(management.Command):
 
         loop = asyncio.get_event_loop()
         loop.run_until_complete(self.check_connection())
+        db.invalidation.start()
+
+        tasks.supervisor.loop = loop
+        for kind, count in (conf.settings.get('task_limits') or {}).items():
+            tasks.supervisor.limit(kind, count)
 
         mainbot = discord.Client(max_messages=100, loop=loop)
         mainbot.add_handlers(self.load_handlers(mainbot))
 
+        stats.reporter.loop = loop
+        stats.reporter.start((conf.settings.get('stats') or {}).get('interval'))
+
         def shutdown():
             asyncio.ensure_future(mainbot.close(), loop=loop)
         loop.add_signal_handler(signal.SIGINT, shutdown)
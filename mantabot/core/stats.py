@@ -0,0 +1,55 @@
+""" Runtime statistics
+
+Components register a function returning their counters. All of them are
+logged together at a regular interval, if one is configured.
+"""
+import asyncio, collections, logging
+from mantabot.core import tasks
+
+logger = logging.getLogger(__name__)
+
+
+class StatsReporter(object):
+    """ Collect and periodically log counters of registered components """
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.sources = collections.OrderedDict()    # name => function returning a dict
+        self.task = None
+
+    def register(self, name, source):
+        """ Have source() called for counters reported under name """
+        self.sources[name] = source
+
+    def unregister(self, name):
+        self.sources.pop(name, None)
+
+    def collect(self):
+        """ Return counters of all sources, by name """
+        result = collections.OrderedDict()
+        for name, source in self.sources.items():
+            try:
+                result[name] = source()
+            except Exception:
+                logger.exception('could not collect %s statistics', name)
+        return result
+
+    def log(self):
+        for name, values in self.collect().items():
+            logger.info('%s: %r', name, values)
+
+    def start(self, interval):
+        """ Log counters every interval seconds, in the background """
+        if interval and self.task is None:
+            self.task = tasks.supervisor.spawn(self.run(interval), 'stats')
+
+    async def run(self, interval):
+        try:
+            while True:
+                await asyncio.sleep(interval, loop=self.loop)
+                self.log()
+        finally:
+            self.task = None
+
+reporter = StatsReporter()
+reporter.register('tasks', tasks.supervisor.counts)
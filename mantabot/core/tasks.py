@@ -0,0 +1,120 @@
+""" Task supervision
+
+Keeps track of running tasks, grouped by kind and guild, so they can be counted,
+capped and cancelled as a group. Registration and removal are O(1).
+"""
+import asyncio, collections
+
+
+class TrackContext(object):
+    """ Context manager that registers current task for its duration
+
+        If the task was already registered, its previous registration is restored
+        on exit, so supervised tasks can nest contexts.
+    """
+    def __init__(self, supervisor, kind, guild=None):
+        self.supervisor = supervisor
+        self.kind = kind
+        self.guild = guild
+
+    def __enter__(self):
+        self.task = task = asyncio.Task.current_task()
+        self.previous = self.supervisor.tasks.get(task)
+        self.supervisor.add(task, self.kind, self.guild)
+        return task
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.previous is None:
+            self.supervisor.discard(self.task)
+        else:
+            self.supervisor.add(self.task, *self.previous)
+
+
+class Supervisor(object):
+    """ Registry of running tasks """
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.tasks = {}                                 # task => (kind, guild_id)
+        self.kinds = collections.defaultdict(set)       # kind => tasks
+        self.guilds = collections.defaultdict(set)      # guild_id => tasks
+        self.limits = {}                                # kind => semaphore
+
+    def limit(self, kind, count):
+        """ Cap the number of tasks of given kind running at once, others wait their turn """
+        self.limits[kind] = asyncio.Semaphore(count, loop=self.loop)
+
+    def spawn(self, coro, kind, guild=None):
+        """ Schedule coroutine in a supervised task, and return the task """
+        semaphore = self.limits.get(kind)
+        if semaphore is not None:
+            coro = self._limited(semaphore, coro)
+        task = asyncio.ensure_future(coro, loop=self.loop)
+        self.add(task, kind, guild)
+        task.add_done_callback(self.discard)
+        return task
+
+    async def _limited(self, semaphore, coro):
+        async with semaphore:
+            return await coro
+
+    def track(self, kind, guild=None):
+        """ Return a context manager that registers current task while it runs """
+        return TrackContext(self, kind, guild)
+
+    def add(self, task, kind, guild=None):
+        """ Register an existing task """
+        guild_id = getattr(guild, 'id', guild)
+        self.discard(task)
+        self.tasks[task] = (kind, guild_id)
+        self.kinds[kind].add(task)
+        if guild_id is not None:
+            self.guilds[guild_id].add(task)
+
+    def discard(self, task):
+        """ Unregister task, if registered """
+        try:
+            kind, guild_id = self.tasks.pop(task)
+        except KeyError:
+            return
+        self._remove(self.kinds, kind, task)
+        if guild_id is not None:
+            self._remove(self.guilds, guild_id, task)
+
+    @staticmethod
+    def _remove(index, key, task):
+        group = index[key]
+        group.discard(task)
+        if not group:
+            del index[key]
+
+    def select(self, kind=None, guild=None):
+        """ Return registered tasks matching kind and guild, None matching any """
+        guild_id = getattr(guild, 'id', guild)
+        if kind is None and guild_id is None:
+            return set(self.tasks)
+        if guild_id is None:
+            return set(self.kinds.get(kind, ()))
+        tasks = set(self.guilds.get(guild_id, ()))
+        if kind is not None:
+            tasks.intersection_update(self.kinds.get(kind, ()))
+        return tasks
+
+    async def cancel(self, kind=None, guild=None, exclude=()):
+        """ Cancel matching tasks and wait for them, returning their results """
+        tasks = self.select(kind, guild).difference(exclude)
+        if not tasks:
+            return []
+        gathered = asyncio.gather(*tasks, loop=self.loop, return_exceptions=True)
+        gathered.cancel()
+        return await gathered
+
+    def counts(self):
+        """ Return live task counts by kind and number of guilds with tasks """
+        return {
+            'total': len(self.tasks),
+            'kinds': {kind: len(tasks) for kind, tasks in self.kinds.items()},
+            'guilds': len(self.guilds),
+        }
+
+supervisor = Supervisor()
@@ -1,10 +1,20 @@
 import aiopg.sa
 import asyncio
+import collections
 import mantabot.conf
 import json
+import logging
 import sqlalchemy
+import time
+import uuid
+import weakref
 from sqlalchemy import *
 from sqlalchemy import sql
+from sqlalchemy.dialects import postgresql
+from mantabot.core import stats as runtime_stats
+from mantabot.util import generation, singleflight
+
+logger = logging.getLogger(__name__)
 
 engines = {}
 
@@ -37,9 +47,26 @@ def management_connection(name='default'):
     engine = sqlalchemy.create_engine(sqlalchemy.engine.url.URL('postgresql', **config))
     return engine.connect()
 
+def any_of(column, values):
+    """ Build a `column = ANY(array)` clause, sending values as a single parameter """
+    return column == sqlalchemy.any_(sqlalchemy.bindparam(
+        '%s_values' % column.name, value=list(values),
+        type_=postgresql.ARRAY(column.type), unique=True,
+    ))
+
+def cache_settings():
+    """ Return the cache configuration section """
+    return (mantabot.conf.settings or {}).get('cache') or {}
+
 async def shutdown():
-    """ Close all open database connections """
+    """ Flush pending writes and close all open database connections """
     global engines
+    try:
+        await writer.flush()
+    except Exception:
+        logger.exception('could not flush pending settings')
+    logger.info('settings writer: %(writes)d writes, %(coalesced)d coalesced saves', writer.stats())
+
     for engine in engines.values():
         engine.close()
 
@@ -54,50 +81,204 @@ SettingsTable = sqlalchemy.Table('settings', metadata,
     sqlalchemy.Column('data', sqlalchemy.Text()),
 )
 
+class ModifyContext(object):
+    """ Context manager that keeps a settings proxy from being reloaded while it is changed
+
+        Changes must be saved before leaving the context, otherwise they can be
+        replaced by the next reload.
+    """
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def __enter__(self):
+        self.proxy.editors += 1
+        return self.proxy
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.proxy.editors -= 1
+
+
 class DBSettingsProxy(dict):
     def __init__(self, app, guild_id, data):
         super(DBSettingsProxy, self).__init__()
         self._app = app
         self._guild_id = guild_id
         self.sequence = 1
+        self.editors = 0    # number of running modify() contexts
+        self.loaded_at = time.monotonic()
         self.update(data)
 
+    def reload(self, data):
+        """ Replace contents with freshly loaded data, keeping object identity """
+        self.clear()
+        self.update(data)
+        self.loaded_at = time.monotonic()
+
+    def modify(self):
+        """ Return a context manager to wrap changes that span awaits, up to save() """
+        return ModifyContext(self)
+
+    @property
+    def is_dirty(self):
+        """ Whether proxy holds changes not written yet, that a reload would lose """
+        return self.editors > 0 or writer.is_pending(self)
+
     async def save(self):
-        data = json.dumps(self)
+        """ Persist settings, deferred and coalesced if write-behind is enabled """
+        self.sequence += 1
+        if writer.delay > 0:
+            writer.schedule(self)
+        else:
+            await writer.write([self])
+
+
+class DBSettingsWriter(object):
+    """ Write-behind queue for settings proxies
+
+        Saves of the same (guild_id, app) pair within the delay window are merged
+        and written as a single upsert of the latest data.
+    """
+    def __init__(self, delay=None, loop=None):
+        self._delay = delay
+        self.loop = loop
+        self.pending = collections.OrderedDict()
+        self.task = None
+        self.lock = None
+        self.writes = 0         # rows actually written
+        self.coalesced = 0      # saves merged into an already pending write
+
+    @property
+    def delay(self):
+        if self._delay is None:
+            return cache_settings().get('write_delay', 0)
+        return self._delay
 
+    def schedule(self, proxy):
+        """ Queue proxy for writing at the end of current window """
+        key = (proxy._guild_id, proxy._app)
+        if key in self.pending:
+            self.coalesced += 1
+        self.pending[key] = proxy
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._delayed_flush(), loop=self.loop)
+
+    def is_pending(self, proxy):
+        return self.pending.get((proxy._guild_id, proxy._app)) is proxy
+
+    async def _delayed_flush(self):
+        try:
+            await asyncio.sleep(self.delay, loop=self.loop)
+        finally:
+            self.task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception('could not write settings, will retry')
+            if self.pending and self.task is None:
+                self.task = asyncio.ensure_future(self._delayed_flush(), loop=self.loop)
+
+    async def flush(self):
+        """ Write all pending proxies now """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if not self.pending:
+                return
+            proxies = list(self.pending.values())
+            self.pending.clear()
+            try:
+                await self.write(proxies)
+            except BaseException:
+                # Put back proxies, unless they were saved again in the meantime
+                for proxy in proxies:
+                    self.pending.setdefault((proxy._guild_id, proxy._app), proxy)
+                raise
+
+    async def write(self, proxies):
+        """ Upsert given proxies in a single statement """
+        query = postgresql.insert(SettingsTable).values([
+            {'guild_id': proxy._guild_id, 'app': proxy._app, 'data': json.dumps(proxy)}
+            for proxy in proxies
+        ])
+        query = query.on_conflict_do_update(
+            index_elements=[SettingsTable.c.guild_id, SettingsTable.c.app],
+            set_={'data': query.excluded.data},
+        )
         async with await connection() as conn:
-            while True:
-                async with conn.begin():
-                    result = await conn.execute(
-                        SettingsTable.update().where(SettingsTable.c.guild_id==self._guild_id)
-                                            .where(SettingsTable.c.app==self._app)
-                                            .values(data=data)
-                    )
-                    if result.rowcount > 0:
-                        break
-                    try:
-                        await conn.execute(
-                            SettingsTable.insert().values(
-                                guild_id=self._guild_id, app=self._app, data=data
-                            )
-                        )
-                    except sqlalchemy.exc.IntegrityError:
-                        continue
-                    break
-        self.sequence += 1
+            async with conn.begin():
+                await conn.execute(query)
+                await invalidation.notify(conn, SettingsTable.name,
+                                          [(proxy._guild_id, proxy._app) for proxy in proxies])
+        self.writes += len(proxies)
+
+    def stats(self):
+        return {'pending': len(self.pending), 'writes': self.writes, 'coalesced': self.coalesced}
 
 
 class DBSettingsCache(object):
-    def __init__(self):
-        self.cache = {}
+    """ Bounded LRU cache of settings proxies, with optional expiration
+
+        Evicted proxies that are still referenced elsewhere, for instance by an
+        in-flight coroutine or the write-behind queue, are kept track of weakly
+        so that the same object is handed out again instead of a diverging copy.
+    """
+    prefetch_batch = 1000   # guilds per query when prefetching
+
+    def __init__(self, max_size=None, ttl=None):
+        self._max_size = max_size
+        self._ttl = ttl
+        self.loaders = {}
+        self.cache = collections.OrderedDict()
+        self.evicted = weakref.WeakValueDictionary()
+        self.loading = singleflight.SingleFlight()
+        self.generations = generation.Generations()     # invalidations by guild id
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_size(self):
+        if self._max_size is None:
+            return cache_settings().get('max_size', 10000)
+        return self._max_size
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            return cache_settings().get('ttl')
+        return self._ttl
+
+    def register(self, app, loader=None):
+        """ Declare an app, so its settings are prefetched and loaded with loader """
+        self.loaders[app] = loader
+
+    def is_stale(self, obj):
+        if obj.loaded_at is None:
+            return True     # invalidated
+        ttl = self.ttl
+        return bool(ttl) and time.monotonic() - obj.loaded_at > ttl
 
     async def get(self, app, guild, loader=None):
         key = (app, guild.id)
-        try:
-            return self.cache[key]
-        except KeyError:
-            pass
-        query = (SettingsTable.select().where(SettingsTable.c.guild_id==guild.id)
+        obj = self.cache.get(key)
+        if obj is None:
+            obj = self.evicted.get(key)
+
+        if obj is not None and not self.is_stale(obj):
+            self.hits += 1
+            self.evicted.pop(key, None)
+            self._store(key, obj)
+            return obj
+        self.misses += 1
+
+        # Concurrent misses share a single query and get the same proxy,
+        # a stale proxy is reloaded in place as it may still be referenced
+        return await self.loading.load(key, self._load, key, loader or self.loaders.get(app), obj)
+
+    async def _load(self, key, loader, current=None):
+        app, guild_id = key
+        mark = self.generations.mark()
+        query = (SettingsTable.select().where(SettingsTable.c.guild_id==guild_id)
                                        .where(SettingsTable.c.app==app))
 
         data = {}
@@ -108,14 +289,211 @@ class DBSettingsCache(object):
 
         if callable(loader):
             data = loader(data)
-        obj = DBSettingsProxy(app, guild.id, data)
-        self.cache[key] = obj
+
+        # Look up the proxy again, it may have been evicted or handed out while loading
+        obj = self.cache.get(key)
+        if obj is None:
+            obj = self.evicted.get(key, current)
+        if obj is None:
+            obj = DBSettingsProxy(app, guild_id, data)
+        elif not obj.is_dirty:
+            obj.reload(data)    # local changes not written yet take precedence
+
+        if not self.generations.changed(guild_id, mark):    # do not cache data invalidated while loading
+            self._store(key, obj)
         return obj
 
+    async def prefetch(self, guild_ids):
+        """ Bulk-load settings of all registered apps for given guilds
+            Guilds with no stored settings get an empty proxy, so they need no query later.
+        """
+        guild_ids, apps = list(guild_ids), list(self.loaders)
+        if not guild_ids or not apps:
+            return
+        mark = self.generations.mark()
+
+        rows = {}
+        async with await connection() as conn:
+            for idx in range(0, len(guild_ids), self.prefetch_batch):
+                query = (SettingsTable.select()
+                            .where(any_of(SettingsTable.c.guild_id, guild_ids[idx:idx + self.prefetch_batch]))
+                            .where(SettingsTable.c.app.in_(apps)))
+                async for row in conn.execute(query):
+                    rows[(row['app'], row['guild_id'])] = json.loads(row['data'])
+
+        max_size = self.max_size
+        for guild_id in guild_ids:
+            for app, loader in self.loaders.items():
+                if max_size and len(self.cache) >= max_size:
+                    return
+                key = (app, guild_id)
+                if key in self.cache or key in self.loading.pending:
+                    continue
+                if self.generations.changed(guild_id, mark):
+                    continue    # invalidated while loading, leave it to regular loading
+                data = rows.get(key, {})
+                if callable(loader):
+                    data = loader(data)
+                # An evicted proxy may still be referenced, hand out that one as _load does
+                obj = self.evicted.pop(key, None)
+                if obj is None:
+                    obj = DBSettingsProxy(app, guild_id, data)
+                elif not obj.is_dirty:
+                    obj.reload(data)
+                self._store(key, obj)
+
+    def _store(self, key, obj):
+        self.cache[key] = obj
+        self.cache.move_to_end(key)
+        max_size = self.max_size
+        while max_size and len(self.cache) > max_size:
+            old_key, old_obj = self.cache.popitem(last=False)
+            self.evicted[old_key] = old_obj
+            self.evictions += 1
+
     def invalidate(self, app, guild):
+        self.invalidate_id(app, guild.id)
+
+    def invalidate_guild(self, guild):
+        """ Drop all settings of given guild """
+        self.invalidate_id(None, guild.id)
+
+    def invalidate_id(self, app, guild_id):
+        """ Drop settings by identifier - app None matches all apps, guild_id None matches all guilds """
+        self.generations.invalidate(guild_id)
+        def match(key):
+            return (app is None or key[0] == app) and (guild_id is None or key[1] == guild_id)
+
+        for key in [key for key in self.loading.pending if match(key)]:
+            self.loading.forget(key)
+        # Proxies may still be referenced, keep them around so they get reloaded in place
+        for key in [key for key in self.cache if match(key)]:
+            self.evicted[key] = self.cache.pop(key)
+        for key in [key for key in self.evicted.keys() if match(key)]:
+            obj = self.evicted.get(key)
+            if obj is not None:
+                obj.loaded_at = None
+
+    def on_notify(self, guild_id, app):
+        self.invalidate_id(app, guild_id)
+
+    def stats(self):
+        return {'size': len(self.cache), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+# ============================================================================
+# Cross-process cache invalidation
+
+class InvalidationListener(object):
+    """ Propagate cache invalidations between bot instances sharing a database
+
+        Writers send a NOTIFY listing (guild_id, app) keys of a table within the
+        writing transaction. Every other instance runs the callbacks registered
+        for that table. Notifications from the instance itself are ignored.
+    """
+    channel = 'mantabot_invalidate'
+    batch_size = 100        # keys per notification, keeps payload under 8000 bytes
+    keepalive = 60          # probe connection after that many idle seconds
+    retry_delay = 5         # wait that many seconds before reconnecting
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.origin = uuid.uuid4().hex
+        self.callbacks = collections.defaultdict(list)
+        self.task = None
+
+    @property
+    def enabled(self):
+        return bool(cache_settings().get('notify', False))
+
+    def register(self, table, callback):
+        """ Have callback(guild_id, app) invoked when other instances change table
+            Both arguments can be None, meaning all guilds or all apps.
+        """
+        self.callbacks[table].append(callback)
+
+    async def notify(self, conn, table, keys):
+        """ Send invalidation for a list of (guild_id, app) keys through conn """
+        if not self.enabled or not keys:
+            return
+        payloads = [
+            json.dumps({'origin': self.origin, 'table': table,
+                        'keys': keys[idx:idx + self.batch_size]})
+            for idx in range(0, len(keys), self.batch_size)
+        ]
+        await conn.execute(sql.select([
+            sql.func.pg_notify(self.channel, payload) for payload in payloads
+        ]))
+
+    def start(self):
+        """ Start listening in the background, if enabled """
+        if self.enabled and self.task is None:
+            self.task = asyncio.ensure_future(self.run(), loop=self.loop)
+
+    async def run(self):
+        """ Listen forever, reconnecting as needed """
+        while True:
+            try:
+                await self.listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning('invalidation listener disconnected: %s', exc)
+
+            # Notifications may have been missed while disconnected
+            self.dispatch_all()
+            await asyncio.sleep(self.retry_delay, loop=self.loop)
+
+    async def listen(self):
         try:
-            del self.cache[(app, guild.id)]
+            config = mantabot.conf.settings['databases']['default']
         except KeyError:
-            pass
+            raise mantabot.conf.ConfigurationError('Unconfigured database default')
+
+        async with aiopg.connect(**config) as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('LISTEN %s' % self.channel)
+            logger.info('listening for cache invalidations')
+
+            while True:
+                try:
+                    notification = await asyncio.wait_for(conn.notifies.get(),
+                                                          self.keepalive, loop=self.loop)
+                except asyncio.TimeoutError:
+                    async with conn.cursor() as cursor:
+                        await cursor.execute('SELECT 1')
+                    continue
+                self.dispatch(notification.payload)
+
+    def dispatch(self, payload):
+        try:
+            data = json.loads(payload)
+            if data['origin'] == self.origin:
+                return
+            callbacks, keys = self.callbacks.get(data['table'], ()), data['keys']
+        except (ValueError, KeyError, TypeError):
+            logger.warning('invalid invalidation payload: %r', payload)
+            return
+
+        for callback in callbacks:
+            for guild_id, app in keys:
+                try:
+                    callback(guild_id, app)
+                except Exception:
+                    logger.exception('invalidation callback failed for %s', data['table'])
+
+    def dispatch_all(self):
+        for table, callbacks in self.callbacks.items():
+            for callback in callbacks:
+                try:
+                    callback(None, None)
+                except Exception:
+                    logger.exception('invalidation callback failed for %s', table)
 
 settings = DBSettingsCache()
+writer = DBSettingsWriter()
+invalidation = InvalidationListener()
+
+runtime_stats.reporter.register('settings', settings.stats)
+runtime_stats.reporter.register('settings_writer', writer.stats)
+invalidation.register(SettingsTable.name, settings.on_notify)
@@ -0,0 +1,32 @@
+""" Invalidation generations
+
+Tells whether a key was invalidated while its data was being loaded, so that
+stale data does not get cached. Invalidating one key does not discard loads
+of other keys.
+"""
+
+
+class Generations(object):
+    """ Track invalidations by key, against a single sequence number """
+
+    def __init__(self):
+        self.sequence = 0
+        self.everything = 0     # sequence number of last invalidation of all keys
+        self.keys = {}          # key => sequence number of its last invalidation
+
+    def mark(self):
+        """ Return a mark to take before loading, and give to changed() afterwards """
+        return self.sequence
+
+    def invalidate(self, key=None):
+        """ Invalidate key, or all keys if None """
+        self.sequence += 1
+        if key is None:
+            self.everything = self.sequence
+            self.keys.clear()
+        else:
+            self.keys[key] = self.sequence
+
+    def changed(self, key, mark):
+        """ Whether key was invalidated since mark was taken """
+        return self.everything > mark or self.keys.get(key, 0) > mark
@@ -0,0 +1,38 @@
+""" Single-flight loading
+
+Collapses concurrent loads of the same key into a single call, all callers
+awaiting the same result.
+"""
+import asyncio
+
+
+class SingleFlight(object):
+    """ Track in-flight loads by key """
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.pending = {}
+
+    async def load(self, key, loader, *args, **kwargs):
+        """ Run loader(*args, **kwargs) unless a load for key is already in flight """
+        try:
+            future = self.pending[key]
+        except KeyError:
+            future = asyncio.ensure_future(loader(*args, **kwargs), loop=self.loop)
+            self.pending[key] = future
+            future.add_done_callback(lambda fut: self._done(key, fut))
+
+        # A cancelled caller must not cancel the load other callers are waiting for
+        return await asyncio.shield(future, loop=self.loop)
+
+    def _done(self, key, future):
+        if self.pending.get(key) is future:
+            del self.pending[key]
+
+    def forget(self, key):
+        """ Make next load for key start afresh, even if one is in flight """
+        self.pending.pop(key, None)
+
+    def clear(self):
+        """ Make next loads start afresh for all keys """
+        self.pending.clear()